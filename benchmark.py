@@ -0,0 +1,321 @@
+#!/usr/bin/env python
+'''
+End-to-end benchmark of modbus-mqtt_client.py. Runs completely offline :
+
+1) starts modbus_server.py in simulator mode on a free high port,
+2) starts the in-process MQTT broker of mini_broker.py on a free port,
+3) starts modbus-mqtt_client.py against both and configures --devices devices through config_delta,
+4) drives it with a mix of requests and reports throughput and p50/p95/p99 latency per path.
+
+Paths :
+    read     - cmd read, correlated reply (mqtt_rpc.py)
+    write    - cmd write, correlated reply
+    read_req - legacy read_req -> data_req. Replies carry no id, so one legacy read is outstanding at a time.
+    config   - config_delta update -> config_version announcing the new device table. One outstanding at a time.
+
+Before the run, --echo QoS 1 messages are sent one at a time to a topic the benchmark itself subscribes to. Their round
+trip through the broker, with no gateway involved, is reported as echo : the floor of the MQTT transport under every path.
+
+    python benchmark.py --requests 5000 --concurrency 50 --mix read=60,write=20,read_req=10,config=10 --output before.json
+
+Results are printed and, with --output, saved as JSON so runs before and after a change can be compared. The JSON also
+holds the metrics the gateway exposed at the end of the run, which break the latency down per unit and topic.
+'''
+
+import argparse
+import collections
+import json
+import math
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import Future, TimeoutError
+from urllib.request import urlopen
+
+import paho.mqtt.client as mqtt
+
+from mini_broker import MiniBroker
+from mqtt_rpc import GatewayClient
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+PATHS = ('read', 'write', 'read_req', 'config')
+
+
+def free_port():
+	sock = socket.socket()
+	sock.bind(('127.0.0.1', 0))
+	port = sock.getsockname()[1]
+	sock.close()
+	return port
+
+
+def wait_for_port(port, timeout=15):
+	deadline = time.monotonic() + timeout
+	while time.monotonic() < deadline:
+		try:
+			socket.create_connection(('127.0.0.1', port), timeout=1).close()
+			return
+		except OSError:
+			time.sleep(0.1)
+	raise RuntimeError("Nothing listening on port %d" % port)
+
+
+#value at percentile p (0-100) of an already sorted list, nearest rank.
+def percentile(values, p):
+	if not values:
+		return None
+	return values[max(0, min(len(values) - 1, int(math.ceil(p / 100.0 * len(values))) - 1))]
+
+
+def summarise(latencies, errors, elapsed):
+	latencies = sorted(latencies)
+	ms = lambda value: None if value is None else round(value * 1000, 3)
+	return {
+		'count': len(latencies),
+		'errors': errors,
+		'throughput': round(len(latencies) / elapsed, 1) if elapsed > 0 else None,
+		'mean_ms': ms(sum(latencies) / len(latencies)) if latencies else None,
+		'p50_ms': ms(percentile(latencies, 50)),
+		'p95_ms': ms(percentile(latencies, 95)),
+		'p99_ms': ms(percentile(latencies, 99)),
+		'max_ms': ms(latencies[-1]) if latencies else None,
+	}
+
+
+#-----------------------------------------------------------------------------------------------------------------------#
+# Paths whose replies cannot be matched to their request. Requests are sent one at a time from a FIFO and the next
+# matching message answers the one in flight. submit() returns a future with the latency measured from sending. A request
+# left unanswered for timeout seconds (the gateway publishes nothing when a legacy read fails) fails with TimeoutError and
+# the next one is sent.
+#-----------------------------------------------------------------------------------------------------------------------#
+class SerialPath(object):
+
+	def __init__(self, client, send, timeout=10):
+		self.client = client
+		self.send = send 				#send(argument) publishes one request
+		self.timeout = timeout
+		self._lock = threading.Lock()
+		self._queue = collections.deque()
+		self._inflight = None 			#(future, send time, timer)
+
+	def submit(self, argument):
+		future = Future()
+		with self._lock:
+			self._queue.append((future, argument))
+			if self._inflight is None:
+				self._send_next()
+		return future
+
+	def answered(self):
+		with self._lock:
+			if self._inflight is None:
+				return
+			future, sent, timer = self._inflight
+			timer.cancel()
+			self._inflight = None
+			self._send_next()
+		future.set_result(time.perf_counter() - sent)
+
+	def _expired(self, future):
+		with self._lock:
+			if self._inflight is None or self._inflight[0] is not future:
+				return
+			self._inflight = None
+			self._send_next()
+		future.set_exception(TimeoutError("No reply within %ss" % self.timeout))
+
+	def _send_next(self):
+		if self._queue:
+			future, argument = self._queue.popleft()
+			timer = threading.Timer(self.timeout, self._expired, (future,))
+			timer.daemon = True
+			self._inflight = (future, time.perf_counter(), timer)
+			timer.start()
+			self.send(argument)
+
+
+def timed(future):
+	start = time.perf_counter()
+	result = Future()
+	def done(finished):
+		if finished.exception() is None:
+			result.set_result(time.perf_counter() - start)
+		else:
+			result.set_exception(finished.exception())
+	future.add_done_callback(done)
+	return result
+
+
+def parse_mix(text):
+	mix = {}
+	for part in text.split(','):
+		name, weight = part.split('=')
+		if name not in PATHS:
+			raise SystemExit("Unknown path %s in --mix, use %s" % (name, ', '.join(PATHS)))
+		mix[name] = float(weight)
+	return mix
+
+
+def main():
+	parser = argparse.ArgumentParser(description="End-to-end benchmark of the Modbus TCP + MQTT gateway")
+	parser.add_argument('--requests', type=int, default=2000)
+	parser.add_argument('--concurrency', type=int, default=20, help="requests in flight at the same time")
+	parser.add_argument('--mix', default='read=60,write=20,read_req=10,config=10', help="weight of every path")
+	parser.add_argument('--devices', type=int, default=50)
+	parser.add_argument('--units', type=int, default=10)
+	parser.add_argument('--ttl', type=float, default=0, help="cache ttl of the devices, 0 sends every read to the server")
+	parser.add_argument('--poll', type=float, default=0, help="poll interval of the devices, 0 disables polling")
+	parser.add_argument('--timeout', type=float, default=30)
+	parser.add_argument('--request-timeout', type=float, default=10, help="seconds after which an unanswered read_req or config request counts as an error")
+	parser.add_argument('--echo', type=int, default=200, help="MQTT round trips through the broker alone to measure before the run, 0 to skip")
+	parser.add_argument('--output', help="file to save the results to as JSON")
+	args = parser.parse_args()
+	mix = parse_mix(args.mix)
+
+	modbus_port = free_port()
+	metrics_port = free_port()
+	workdir = tempfile.mkdtemp(prefix='benchmark-') 	#fresh snapshot and telemetry buffer for every run
+	broker = MiniBroker(port=0)
+	broker.start()
+	processes = []
+	try:
+		processes.append(subprocess.Popen([sys.executable, os.path.join(HERE, 'modbus_server.py'), '--simulate', '--units', str(args.units),
+			'--size', '1000', '--port', str(modbus_port)], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+		wait_for_port(modbus_port)
+		processes.append(subprocess.Popen([sys.executable, os.path.join(HERE, 'modbus-mqtt_client.py'), '--broker', '127.0.0.1',
+			'--broker-port', str(broker.port), '--modbus-host', '127.0.0.1', '--modbus-port', str(modbus_port),
+			'--metrics-port', str(metrics_port), '--snapshot', os.path.join(workdir, 'device_table.json'),
+			'--buffer-file', os.path.join(workdir, 'telemetry.buf')], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+		results = run(args, mix, broker.port)
+		try:
+			results['metrics'] = urlopen('http://127.0.0.1:%d/metrics' % metrics_port, timeout=5).read().decode('utf-8')
+		except OSError as e:
+			print("Could not read the gateway metrics :", e)
+	finally:
+		for process in processes:
+			process.terminate()
+		for process in processes:
+			process.wait()
+		broker.stop()
+
+	print("%-9s %8s %7s %10s %9s %9s %9s %9s" % ('path', 'count', 'errors', 'ops/s', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms'))
+	rows = sorted(results['paths'].items()) + [('total', results['total'])]
+	if results['echo']:
+		rows.insert(0, ('echo', results['echo']))
+	for name, summary in rows:
+		print("%-9s %8s %7s %10s %9s %9s %9s %9s" % (name, summary['count'], summary['errors'], summary['throughput'],
+			summary['p50_ms'], summary['p95_ms'], summary['p99_ms'], summary['max_ms']))
+	if args.output:
+		with open(args.output, 'w') as out:
+			json.dump(results, out, indent=2)
+		print("Results saved to", args.output)
+
+
+#round trip of count QoS 1 messages, one at a time, from client to itself through the broker. None if count is 0.
+def measure_echo(client, count, timeout):
+	if not count:
+		return None
+	topic = 'benchmark/echo/%d' % os.getpid()
+	echo = SerialPath(client, lambda i: client.publish(topic, str(i), qos=1), timeout)
+	client.message_callback_add(topic, lambda c, userdata, message: echo.answered())
+	subscribed = threading.Event()
+	client.on_subscribe = lambda c, userdata, mid, granted_qos: subscribed.set()
+	client.subscribe(topic, qos=1)
+	subscribed.wait(timeout)
+	client.on_subscribe = None
+	latencies, errors = [], 0
+	start = time.perf_counter()
+	for i in range(count):
+		try:
+			latencies.append(echo.submit(i).result())
+		except TimeoutError:
+			errors += 1
+	summary = summarise(latencies, errors, time.perf_counter() - start)
+	client.unsubscribe(topic)
+	client.message_callback_remove(topic)
+	return summary
+
+
+def run(args, mix, broker_port):
+	devices = ['dev%d' % i for i in range(args.devices)]
+	versions = [0]
+	client = mqtt.Client("BENCH-%d" % os.getpid())
+	client.connect('127.0.0.1', broker_port)
+	client.socket().setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1) 	#else Nagle holds requests back for the ACK of the last one
+	client.loop_start()
+	echo = measure_echo(client, args.echo, args.request_timeout)
+
+	legacy = SerialPath(client, lambda device: client.publish('read_req', device, qos=0), args.request_timeout)
+	config = SerialPath(client, lambda device: client.publish('config_delta', json.dumps({'update': {device: {'ttl': args.ttl}}}), qos=1),
+		args.request_timeout)
+	def on_config_version(c, userdata, message):
+		versions[0] = int(message.payload)
+		config.answered()
+	client.message_callback_add('data_req', lambda c, userdata, message: legacy.answered())
+	client.message_callback_add('config_version', on_config_version)
+	client.subscribe([('data_req', 1), ('config_version', 1)])
+	gateway = GatewayClient(client, "BENCH-%d" % os.getpid(), timeout=args.timeout)
+
+	#add every device, repeating until the gateway (which may still be starting) announces a device table
+	add = {'add': dict((device, {'unit': 1 + i % args.units, 'register': i // args.units, 'interval': args.poll, 'ttl': args.ttl})
+		for i, device in enumerate(devices))}
+	deadline = time.monotonic() + args.timeout
+	while versions[0] == 0:
+		if time.monotonic() > deadline:
+			raise RuntimeError("Gateway did not come up")
+		client.publish('config_delta', json.dumps(add), qos=1)
+		time.sleep(1)
+
+	submit = {
+		'read': lambda device: timed(gateway.read(device)),
+		'write': lambda device: timed(gateway.write(device, random.randint(0, 1000))),
+		'read_req': legacy.submit,
+		'config': config.submit,
+	}
+	names = list(mix)
+	ops = random.choices(names, [mix[name] for name in names], k=args.requests)
+	window = threading.Semaphore(args.concurrency)
+	lock = threading.Lock()
+	latencies = dict((name, []) for name in names)
+	errors = dict((name, 0) for name in names)
+	finished = threading.Event()
+	remaining = [len(ops)]
+
+	def done(name, future):
+		with lock:
+			if future.exception() is None:
+				latencies[name].append(future.result())
+			else:
+				errors[name] += 1
+			remaining[0] -= 1
+			if not remaining[0]:
+				finished.set()
+		window.release()
+
+	start = time.perf_counter()
+	for name in ops:
+		window.acquire()
+		submit[name](random.choice(devices)).add_done_callback(lambda future, name=name: done(name, future))
+	if not finished.wait(args.timeout + 5):
+		raise RuntimeError("%d requests never finished" % remaining[0])
+	elapsed = time.perf_counter() - start
+	client.loop_stop()
+	client.disconnect()
+
+	return {
+		'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+		'params': vars(args),
+		'elapsed_s': round(elapsed, 3),
+		'echo': echo,
+		'paths': dict((name, summarise(latencies[name], errors[name], elapsed)) for name in names),
+		'total': summarise([value for name in names for value in latencies[name]], sum(errors.values()), elapsed),
+	}
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+"""
+Compact pymodbus datablock backed by an array instead of a Python list.
+
+ModbusSequentialDataBlock keeps one Python int object per register, which makes large address spaces on hundreds of
+simulated units expensive. ArrayDataBlock stores the same values in an array.array, two bytes per register, and is
+used by the simulator mode of modbus_server.py. It can be used wherever a ModbusSequentialDataBlock can::
+
+    store = ModbusSlaveContext(hr=ArrayDataBlock(0, 10000), ir=ArrayDataBlock(0, 10000))
+
+MappedDataBlock keeps the values in a memory mapped file instead (modbus_server.py --datastore), so they survive a
+restart of the server, and a gateway on the same host reads them straight from the shared memory with
+MappedRegisters (modbus-mqtt_client.py --shared-datastore) instead of a MODBUS TCP round trip::
+
+    store = ModbusSlaveContext(hr=MappedDataBlock(datastore_path('/var/lib/modbus', 1, 'hr'), 0, 10000))
+    MappedRegisters(datastore_path('/var/lib/modbus', 1, 'hr')).read(0, 10)     # in the gateway
+
+The file starts with a header holding a sequence counter, a seqlock : a writer makes it odd before changing values and
+even again afterwards. A reader copies the values between two reads of the counter and retries when it was odd or
+changed meanwhile, so it never sees a write half done and never blocks the server.
+"""
+import mmap
+import os
+import struct
+import threading
+import time
+from array import array
+
+from pymodbus.datastore.store import BaseModbusDataBlock
+
+_MAGIC = b'MBRG'
+_VERSION = 1
+_HEADER = struct.Struct('<4sHcxIIQ')     # magic, version, typecode, start address, count, sequence counter
+_SEQUENCE = struct.Struct('<Q')
+_SEQUENCE_OFFSET = 16
+_HEADER_SIZE = 64                       # values start on their own cache line
+READ_TIMEOUT = 0.05                     # seconds a reader waits for a write in progress before giving up
+
+
+def datastore_path(directory, unit, table):
+    """ File of table ('hr', 'ir', 'co' or 'di') of unit in directory. Unit 0 stands for every unit of a single context """
+    return os.path.join(directory, 'unit%d-%s.regs' % (unit, table))
+
+
+class ArrayDataBlock(BaseModbusDataBlock):
+    """ A sequential datablock of count registers starting at address, stored in an array of typecode """
+
+    def __init__(self, address, count, value=0, typecode='H'):
+        self.address = address
+        self.default_value = value
+        self.values = array(typecode, [value]) * count
+
+    def default(self, count, value=False):
+        self.default_value = value
+        self.values = array(self.values.typecode, [value]) * count
+        self.address = 0x00
+
+    def reset(self):
+        self.values = array(self.values.typecode, [self.default_value]) * len(self.values)
+
+    def validate(self, address, count=1):
+        return self.address <= address and address + count <= self.address + len(self.values)
+
+    def getValues(self, address, count=1):
+        start = address - self.address
+        return self.values[start:start + count].tolist()
+
+    def setValues(self, address, values):
+        if not isinstance(values, list):
+            values = [values]
+        start = address - self.address
+        self.values[start:start + len(values)] = array(self.values.typecode, values)
+
+
+class MappedDataBlock(BaseModbusDataBlock):
+    """ A sequential datablock of count registers starting at address, stored in the memory mapped file path
+
+    Values already in the file are kept when its start address, count and typecode match, else the file is replaced
+    with one holding value everywhere. A replaced file is written aside and renamed over the old one, so readers still
+    mapping the old file never see it shrink under them.
+    """
+
+    def __init__(self, path, address, count, value=0, typecode='H'):
+        self.path = path
+        self.address = address
+        self.default_value = value
+        self._lock = threading.Lock()       # serialises writers, the sync server runs a thread per connection
+        self._open(count, typecode)
+
+    def _open(self, count, typecode):
+        size = _HEADER_SIZE + count * array(typecode).itemsize
+        try:
+            with open(self.path, 'r+b') as f:
+                header = f.read(_HEADER.size)
+                if len(header) == _HEADER.size and os.fstat(f.fileno()).st_size == size:
+                    magic, version, stored_typecode, address, stored_count, sequence = _HEADER.unpack(header)
+                    if (magic, version, stored_typecode, address, stored_count) == (_MAGIC, _VERSION, typecode.encode(), self.address, count):
+                        self._map = mmap.mmap(f.fileno(), size)
+                        self._sequence = sequence & ~1      # a writer stopped half way, its values are what is left
+                        _SEQUENCE.pack_into(self._map, _SEQUENCE_OFFSET, self._sequence)    # else readers wait for it forever
+                        self.values = memoryview(self._map)[_HEADER_SIZE:].cast(typecode)
+                        return
+        except FileNotFoundError:
+            pass
+        fresh = self.path + '.tmp'
+        with open(fresh, 'wb') as f:
+            f.write(_HEADER.pack(_MAGIC, _VERSION, typecode.encode(), self.address, count, 0).ljust(_HEADER_SIZE, b'\0'))
+            f.write(array(typecode, [self.default_value] * count).tobytes())
+        os.replace(fresh, self.path)
+        with open(self.path, 'r+b') as f:
+            self._map = mmap.mmap(f.fileno(), size)
+        self._sequence = 0
+        self.values = memoryview(self._map)[_HEADER_SIZE:].cast(typecode)
+
+    def default(self, count, value=False):
+        self.default_value = value
+        self.address = 0x00
+        typecode = self.values.format
+        self.values.release()
+        self._map.close()
+        self._open(count, typecode)
+        self.reset()
+
+    def reset(self):
+        self.setValues(self.address, [self.default_value] * len(self.values))
+
+    def validate(self, address, count=1):
+        return self.address <= address and address + count <= self.address + len(self.values)
+
+    def getValues(self, address, count=1):
+        start = address - self.address
+        with self._lock:                    # values only change under the lock in this process
+            return self.values[start:start + count].tolist()
+
+    def setValues(self, address, values):
+        if not isinstance(values, list):
+            values = [values]
+        start = address - self.address
+        with self._lock:
+            _SEQUENCE.pack_into(self._map, _SEQUENCE_OFFSET, self._sequence + 1)     # odd : write in progress
+            self.values[start:start + len(values)] = array(self.values.format, values)
+            self._sequence += 2
+            _SEQUENCE.pack_into(self._map, _SEQUENCE_OFFSET, self._sequence)
+
+    def flush(self):
+        self._map.flush()
+
+
+class MappedRegisters(object):
+    """ Read only view of the file of a MappedDataBlock, for another process on the same host
+
+    read() takes the register of a MODBUS request, so it returns what a read_holding_registers of the server would,
+    given the zero_mode of the ModbusSlaveContext serving the block. When the server replaced the file, e.g. after
+    its size changed, the new one is mapped on the next read.
+    """
+
+    def __init__(self, path, zero_mode=False):
+        self.path = path
+        self.offset = 0 if zero_mode else 1     # ModbusSlaveContext adds 1 to every address unless in zero_mode
+        self._lock = threading.Lock()           # keeps a remap from closing the map under a read of another thread
+        self._map = None
+        self._inode = None
+        self._open()
+
+    def _open(self):
+        with open(self.path, 'rb') as f:
+            inode = os.fstat(f.fileno()).st_ino
+            magic, version, typecode, self.address, count, sequence = _HEADER.unpack(f.read(_HEADER.size))
+            if magic != _MAGIC or version != _VERSION:
+                raise ValueError("%s is not a register file" % self.path)
+            new_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._map is not None:
+            self.values.release()
+            self._map.close()
+        self._map = new_map
+        self._inode = inode
+        self.values = memoryview(new_map)[_HEADER_SIZE:_HEADER_SIZE + count * array(typecode.decode()).itemsize].cast(typecode.decode())
+
+    def read(self, register, count=1):
+        """ Returns the values of count registers from register. Raises ValueError if they are outside the block,
+        TimeoutError if a write stays in progress for READ_TIMEOUT, e.g. because the server died in the middle of it
+        """
+        with self._lock:
+            if os.stat(self.path).st_ino != self._inode:
+                self._open()
+            start = register + self.offset - self.address
+            if start < 0 or start + count > len(self.values):
+                raise ValueError("Registers %d-%d are outside %s" % (register, register + count - 1, self.path))
+            attempts = 0
+            deadline = None
+            while True:
+                sequence = _SEQUENCE.unpack_from(self._map, _SEQUENCE_OFFSET)[0]
+                if not sequence & 1:
+                    values = self.values[start:start + count].tolist()
+                    if _SEQUENCE.unpack_from(self._map, _SEQUENCE_OFFSET)[0] == sequence:
+                        return values
+                attempts += 1
+                if attempts % 100 == 0:
+                    deadline = deadline or time.monotonic() + READ_TIMEOUT
+                    if time.monotonic() > deadline:
+                        raise TimeoutError("Write in progress in %s for %gs" % (self.path, READ_TIMEOUT))
+                    time.sleep(0)               # let the writer finish
@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+'''
+Compiled device table of modbus-mqtt_client.py.
+
+reg_config, slave_config and poll_config hold strings keyed by device name. Parsing them on every request costs time
+and, as they arrive on different topics, the handlers can see one updated and the other not. The gateway instead
+compiles them once into a DeviceTable : an immutable map of device name to Device, with the unit, register and poll
+interval already parsed and a version number. A new table is built aside and swapped in with one assignment, so a
+handler always sees one consistent version.
+
+Small changes do not need the whole config to be republished. apply_delta() builds the next table from a delta :
+
+    {"add":    {"boiler": {"unit": 3, "register": 12, "type": "float32", "scale": 0.1, "word_order": "little",
+                           "interval": 5, "ttl": 1, "deadband": "2%", "endpoint": "rtu:///dev/ttyUSB0?baudrate=19200"}},
+     "update": {"temp_sensor": {"register": 6}},
+     "remove": ["energy_meter"]}
+
+add requires unit and register. update changes only the given fields of an existing device. A delta is applied
+completely or not at all.
+
+save_snapshot() writes a table to a JSON file and load_snapshot() reads it back, so a restarted gateway can serve
+requests with its last table before any config has been received. Only the fields each device was given are saved,
+the others take the defaults of the gateway loading it. lock_snapshot() keeps two gateways started from the
+same directory from writing the same snapshot.
+'''
+
+import fcntl
+import json
+import os
+from collections import namedtuple
+from types import MappingProxyType
+
+from payload_codec import TYPE_FORMATS, BYTE_ORDERS, register_count
+from modbus_endpoints import endpoint_text
+
+import logging
+log = logging.getLogger(__name__)
+
+DEFAULT_TYPE = 'uint16'
+DEFAULT_ENDPOINT = 'tcp://localhost:502'
+
+#--------------------------------------------------------------------------------------------------------------------------#
+# One compiled device.
+# interval     - poll interval in seconds, 0 if the device is not polled.
+# ttl          - seconds a value read from the device may be served from the cache, 0 to always read the device.
+# deadband     - a polled value is only published when it moved more than this from the last published value. Given as a
+#                number, or as a string like "2%" for a percentage of the last published value (deadband_pct is then True).
+# min_interval - least number of seconds between two publishes of the device.
+# max_age      - a value is published at least every max_age seconds even if it did not change, 0 for no heartbeat.
+# count        - number of registers the value takes, given by dtype.
+# scale        - the value of the device is its raw register value times scale.
+# byte_order   - 'big' or 'little', order of the two bytes inside each register.
+# word_order   - 'big' or 'little', order of the registers of a value taking more than one register.
+# endpoint     - canonical text of the MODBUS endpoint the slave is reached through, see modbus_endpoints.py.
+# fields       - the fields the device was given, as sorted (name, value) pairs. The others follow the defaults of the gateway.
+#--------------------------------------------------------------------------------------------------------------------------#
+Device = namedtuple('Device', ['name', 'unit', 'register', 'dtype', 'interval', 'ttl',
+	'deadband', 'deadband_pct', 'min_interval', 'max_age', 'count', 'scale', 'byte_order', 'word_order', 'endpoint', 'fields'])
+
+FIELDS = ('unit', 'register', 'type', 'interval', 'ttl', 'deadband', 'min_interval', 'max_age', 'scale', 'byte_order',
+	'word_order', 'endpoint')
+
+
+#--------------------------------------------------------------------------------------------------------------#
+# Parses the fields of one device into a Device. unit and register are required, the other fields are taken
+# from defaults when missing. Raises ValueError if a field is missing or invalid.
+#--------------------------------------------------------------------------------------------------------------#
+def make_device(name, fields, defaults=None):
+	merged = dict(defaults or {})
+	merged.update(fields)
+	try:
+		unit = int(merged['unit'])
+		register = int(merged['register'])
+		interval = float(merged.get('interval', 0))
+		ttl = float(merged.get('ttl', 0))
+		deadband = merged.get('deadband', 0)
+		deadband_pct = isinstance(deadband, str) and deadband.strip().endswith('%')
+		deadband = float(deadband.strip()[:-1]) if deadband_pct else float(deadband)
+		min_interval = float(merged.get('min_interval', 0))
+		max_age = float(merged.get('max_age', 0))
+		scale = float(merged.get('scale', 1))
+	except KeyError as e:
+		raise ValueError("Device %s has no %s" % (name, e.args[0]))
+	except (TypeError, AttributeError):
+		raise ValueError("Device %s has an invalid field" % name)
+	dtype = merged.get('type') or DEFAULT_TYPE
+	if dtype not in TYPE_FORMATS:
+		raise ValueError("Device %s has unknown type %s" % (name, dtype))
+	byte_order = merged.get('byte_order') or 'big'
+	word_order = merged.get('word_order') or 'big'
+	if byte_order not in BYTE_ORDERS or word_order not in BYTE_ORDERS:
+		raise ValueError("Device %s has an invalid byte or word order" % name)
+	if scale == 0:
+		raise ValueError("Device %s has a scale of 0" % name)
+	try:
+		endpoint = endpoint_text(merged.get('endpoint') or DEFAULT_ENDPOINT)
+	except ValueError as e:
+		raise ValueError("Device %s : %s" % (name, e))
+	count = register_count(dtype)
+	if not 0 <= unit <= 255 or not 0 <= register <= 0x10000 - count:
+		raise ValueError("Device %s has an invalid unit or register" % name)
+	given = tuple(sorted((field, value) for field, value in fields.items() if field in FIELDS))
+	return Device(name, unit, register, dtype, interval, ttl, deadband, deadband_pct, min_interval, max_age,
+		count, scale, byte_order, word_order, endpoint, given)
+
+
+#-----------------------------------------------------------------------------------------------------------------------#
+# Returns the fields dev was given, so that make_device(dev.name, device_fields(dev), defaults) == dev. The fields left
+# to the defaults are not in it, so a device saved and loaded again follows defaults which changed meanwhile (e.g. the
+# endpoint of a gateway restarted with another --modbus-host).
+#-----------------------------------------------------------------------------------------------------------------------#
+def device_fields(dev):
+	return dict(dev.fields)
+
+
+class DeviceTable(object):
+
+	def __init__(self, devices=None, version=0):
+		self.devices = MappingProxyType(dict(devices or {})) 	#device name -> Device, read only
+		self.version = version
+
+	def get(self, name):
+		return self.devices.get(name)
+
+	def __len__(self):
+		return len(self.devices)
+
+	def __contains__(self, name):
+		return name in self.devices
+
+
+#----------------------------------------------------------------------------------------------------------------------#
+# Compiles the full configs into a table. Devices which are only in one of reg_config and slave_config, or whose
+# values do not parse, are left out. poll_config is optional per device. extra_config holds the other fields of a device
+# (type, ttl, deadband, ...) which have no config topic of their own, as they are only set through deltas.
+# defaults gives the value of every field a device does not set.
+#----------------------------------------------------------------------------------------------------------------------#
+def compile_table(reg_config, slave_config, poll_config=None, extra_config=None, defaults=None, version=0):
+	poll_config = poll_config or {}
+	extra_config = extra_config or {}
+	devices = {}
+	for name in reg_config:
+		if name not in slave_config:
+			continue
+		fields = dict(extra_config.get(name, {}))
+		fields['unit'] = slave_config[name]
+		fields['register'] = reg_config[name]
+		if name in poll_config:
+			fields['interval'] = poll_config[name]
+		try:
+			devices[name] = make_device(name, fields, defaults)
+		except ValueError as e:
+			log.warning("Skipping device : %s", e)
+	return DeviceTable(devices, version)
+
+
+#returns the table following table with delta applied. Raises ValueError, leaving table untouched, if the delta is invalid.
+def apply_delta(table, delta, defaults=None):
+	if not isinstance(delta, dict):
+		raise ValueError("Delta must be a JSON object")
+	devices = dict(table.devices)
+	for name, fields in delta.get('add', {}).items():
+		devices[name] = make_device(name, fields, defaults)
+	for name, fields in delta.get('update', {}).items():
+		if name not in devices:
+			raise ValueError("Unknown device " + name)
+		merged = device_fields(devices[name])
+		merged.update(fields)
+		devices[name] = make_device(name, merged, defaults)
+	for name in delta.get('remove', []):
+		devices.pop(name, None)
+	return DeviceTable(devices, table.version + 1)
+
+
+#-----------------------------------------------------------------------------------------------------------------------#
+# Saves table to path as {"version": n, "devices": {name: fields}, "configs": configs}. configs maps each config topic
+# to the payload the table was last compiled from. The file is written aside and renamed over the old one, so a crash
+# while saving leaves the previous snapshot intact.
+#-----------------------------------------------------------------------------------------------------------------------#
+def save_snapshot(table, path, configs=None):
+	snapshot = {'version': table.version, 'devices': dict((name, device_fields(dev)) for name, dev in table.devices.items()),
+		'configs': dict(configs or {})}
+	tmp = path + '.tmp'
+	with open(tmp, 'w') as f:
+		json.dump(snapshot, f)
+	os.replace(tmp, path)
+
+
+#--------------------------------------------------------------------------------------------------------------------#
+# Takes an exclusive lock on the snapshot in path, held until the returned file is closed or the process exits.
+# Returns None if another process holds it.
+#--------------------------------------------------------------------------------------------------------------------#
+def lock_snapshot(path):
+	lock = open(path + '.lock', 'a')
+	try:
+		fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+	except OSError:
+		lock.close()
+		return None
+	return lock
+
+
+#--------------------------------------------------------------------------------------------------------------------#
+# Returns the table and the config payloads saved by save_snapshot() in path.
+# Raises OSError if it cannot be read and ValueError if it is invalid.
+#--------------------------------------------------------------------------------------------------------------------#
+def load_snapshot(path, defaults=None):
+	with open(path) as f:
+		snapshot = json.load(f)
+	try:
+		devices = dict((name, make_device(name, fields, defaults)) for name, fields in snapshot['devices'].items())
+		return DeviceTable(devices, int(snapshot['version'])), dict(snapshot.get('configs', {}))
+	except (KeyError, TypeError, AttributeError):
+		raise ValueError("Invalid device table snapshot " + path)
@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+'''
+asyncio dispatch core of modbus-mqtt_client.py.
+
+paho calls the message handlers from its network thread, so a MODBUS call made inside a handler stalls every other
+message until the slave answers. The handlers instead submit their MODBUS work here and return at once.
+
+Requests wait in a bounded queue, one per slave unit, and are started in arrival order, with at most unit_limit
+requests running per slave unit at a time, so one slow or dead slave only holds up its own requests. Every request has
+a deadline counted from submission, and a request still waiting when its deadline passes fails right then. When the
+queue is full a new request is either rejected or the oldest waiting request is dropped, depending on the overflow
+policy.
+
+The MODBUS clients are blocking, so each request runs in a thread of a fixed size pool driven from the event loop.
+
+DispatcherGroup gives every MODBUS endpoint its own dispatcher, with its own queue, threads and event loop, so a slow
+serial line or an unreachable server fills and times out only its own queue while other endpoints keep their pace.
+'''
+
+import asyncio
+import collections
+import heapq
+import itertools
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError
+
+import logging
+log = logging.getLogger(__name__)
+
+REJECT = 'reject' 				#overflow policy : fail the new request
+DROP_OLDEST = 'drop_oldest' 	#overflow policy : fail the oldest waiting request and queue the new one
+
+
+#raised through the future of a request which was shed because the queue was full.
+class DispatcherFullError(Exception):
+	pass
+
+
+#fails future unless whoever submitted it has cancelled it already.
+def _fail(future, exc):
+	if not future.cancelled():
+		future.set_exception(exc)
+
+
+#a request of the dispatcher. Requests which expire or are dropped stay in their unit queue until they reach its head.
+class _Job(object):
+	__slots__ = ('unit', 'fn', 'args', 'future', 'deadline', 'seq', 'timer', 'waiting')
+
+	def __init__(self, unit, fn, args, future, deadline):
+		self.unit = unit
+		self.fn = fn
+		self.args = args
+		self.future = future
+		self.deadline = deadline
+		self.seq = None 				#arrival order
+		self.timer = None 				#fails the request when its deadline passes while it waits
+		self.waiting = False
+
+
+class AsyncDispatcher(object):
+
+	#-----------------------------------------------------------------------------------------------------------------#
+	# max_queue  - number of requests allowed to wait. Requests already running are not counted.
+	# unit_limit - number of requests run at the same time against one slave unit.
+	# timeout    - seconds from submit() until the future of a request fails with TimeoutError.
+	# overflow   - REJECT or DROP_OLDEST, what to do when a request arrives and the queue is full.
+	# workers    - number of requests running at the same time over all units.
+	#-----------------------------------------------------------------------------------------------------------------#
+	def __init__(self, max_queue=1000, unit_limit=1, timeout=5.0, overflow=REJECT, workers=16):
+		if overflow not in (REJECT, DROP_OLDEST):
+			raise ValueError("Unknown overflow policy " + str(overflow))
+		self.max_queue = max_queue
+		self.unit_limit = unit_limit
+		self.timeout = timeout
+		self.overflow = overflow
+		self.workers = workers
+		self._queues = {} 							#unit -> deque of its jobs in arrival order
+		self._ready = [] 							#heap of (seq of the first waiting job, unit) of units with room to run
+		self._order = collections.deque() 			#all jobs in arrival order, to find the oldest waiting one
+		self._depth = 0 							#number of waiting jobs
+		self._seq = itertools.count()
+		self._running = collections.Counter() 		#unit -> number of running requests
+		self._total_running = 0
+		self._executor = ThreadPoolExecutor(max_workers=workers)
+		self._loop = asyncio.new_event_loop()
+		self._thread = threading.Thread(target=self._loop.run_forever, name="AsyncDispatcher")
+		self._thread.daemon = True
+
+	def start(self):
+		self._thread.start()
+
+	def stop(self):
+		self._loop.call_soon_threadsafe(self._loop.stop)
+		self._thread.join()
+		self._executor.shutdown(wait=False)
+
+	#number of requests waiting to run.
+	def queue_depth(self):
+		return self._depth
+
+	#-----------------------------------------------------------------------------------------------------------------#
+	# Queues fn(*args) to run against slave unit. Can be called from any thread.
+	# Returns a concurrent.futures.Future with the return value of fn, or failing with the exception fn raised,
+	# TimeoutError or DispatcherFullError. Callbacks added to the future run in the dispatcher thread.
+	#-----------------------------------------------------------------------------------------------------------------#
+	def submit(self, unit, fn, *args):
+		future = Future()
+		job = _Job(unit, fn, args, future, time.monotonic() + self.timeout)
+		self._loop.call_soon_threadsafe(self._enqueue, job)
+		return future
+
+	def _enqueue(self, job):
+		while self._order and not self._order[0].waiting:
+			self._order.popleft()
+		if self._depth >= self.max_queue:
+			if self.overflow == REJECT:
+				_fail(job.future, DispatcherFullError("Request queue full"))
+				return
+			self._discard(self._order[0], DispatcherFullError("Dropped from full request queue"))
+		job.seq = next(self._seq)
+		job.waiting = True
+		job.timer = self._loop.call_at(job.deadline, self._expire, job) 	#the loop runs on time.monotonic()
+		queue = self._queues.setdefault(job.unit, collections.deque())
+		queue.append(job)
+		self._order.append(job)
+		self._depth += 1
+		if len(queue) == 1 and self._running[job.unit] < self.unit_limit:
+			heapq.heappush(self._ready, (job.seq, job.unit))
+		self._pump()
+
+	def _expire(self, job):
+		if job.waiting:
+			self._discard(job, TimeoutError("Request expired in queue"))
+
+	#takes job out of the waiting jobs and fails it with exc.
+	def _discard(self, job, exc):
+		job.waiting = False
+		job.timer.cancel()
+		self._depth -= 1
+		_fail(job.future, exc)
+
+	#first waiting job of unit, dropping the expired and dropped ones before it. None if it has none.
+	def _head(self, unit):
+		queue = self._queues.get(unit)
+		while queue and not queue[0].waiting:
+			queue.popleft()
+		if not queue:
+			self._queues.pop(unit, None)
+			return None
+		return queue[0]
+
+	#starts waiting requests, oldest first, as long as their unit and the pool have room.
+	def _pump(self):
+		while self._ready and self._total_running < self.workers:
+			seq, unit = heapq.heappop(self._ready)
+			job = self._head(unit)
+			if job is None or self._running[unit] >= self.unit_limit:
+				continue 					#the unit is pushed again when one of its requests finishes
+			if job.seq != seq:
+				heapq.heappush(self._ready, (job.seq, unit)) 	#its first job changed, requeue it in its place
+				continue
+			self._queues[unit].popleft()
+			job.waiting = False
+			job.timer.cancel()
+			self._depth -= 1
+			if not job.future.set_running_or_notify_cancel():
+				heapq.heappush(self._ready, (seq, unit)) 		#cancelled, _head() moves on to the next one
+				continue
+			self._running[unit] += 1
+			self._total_running += 1
+			self._loop.create_task(self._run(job))
+			self._ready_again(unit)
+
+	#puts unit back on the ready heap if it has a waiting job and room to run it.
+	def _ready_again(self, unit):
+		if self._running[unit] < self.unit_limit:
+			job = self._head(unit)
+			if job is not None:
+				heapq.heappush(self._ready, (job.seq, unit))
+
+	async def _run(self, job):
+		unit, fn, args, future, deadline = job.unit, job.fn, job.args, job.future, job.deadline
+		try:
+			call = self._loop.run_in_executor(self._executor, fn, *args)
+			done, pending = await asyncio.wait([call], timeout=max(deadline - time.monotonic(), 0))
+			if pending:
+				future.set_exception(TimeoutError("No response from unit %s in time" % unit))
+				#a blocking MODBUS call cannot be cancelled, the unit stays busy until its thread returns
+				await asyncio.wait([call])
+			if not future.done():
+				if call.exception() is not None:
+					future.set_exception(call.exception())
+				else:
+					future.set_result(call.result())
+		except Exception:
+			log.exception("Dispatching request to unit %s failed", unit)
+		finally:
+			self._running[unit] -= 1
+			if not self._running[unit]:
+				del self._running[unit]
+			self._total_running -= 1
+			self._ready_again(unit)
+			self._pump()
+
+
+class DispatcherGroup(object):
+
+	#-----------------------------------------------------------------------------------------------------------------#
+	# factory - factory(key) returns a new, not yet started AsyncDispatcher for key. It is called the first time a
+	#           request is submitted for key, so the dispatchers follow the endpoints in use.
+	#-----------------------------------------------------------------------------------------------------------------#
+	def __init__(self, factory):
+		self.factory = factory
+		self._lock = threading.Lock()
+		self._dispatchers = {} 		#key -> started AsyncDispatcher
+
+	def get(self, key):
+		dispatcher = self._dispatchers.get(key)
+		if dispatcher is None:
+			with self._lock:
+				dispatcher = self._dispatchers.get(key)
+				if dispatcher is None:
+					dispatcher = self.factory(key)
+					dispatcher.start()
+					self._dispatchers[key] = dispatcher
+		return dispatcher
+
+	#queues fn(*args) on the dispatcher of key against slave unit, see AsyncDispatcher.submit().
+	def submit(self, key, unit, fn, *args):
+		return self.get(key).submit(unit, fn, *args)
+
+	def stop(self):
+		with self._lock:
+			dispatchers, self._dispatchers = self._dispatchers, {}
+		for dispatcher in dispatchers.values():
+			dispatcher.stop()
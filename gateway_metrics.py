@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+'''
+Hot path metrics and sampled structured logging for modbus-mqtt_client.py.
+
+Metrics holds counters, gauges and latency histograms, each with optional labels such as the slave unit or the MQTT
+topic, and renders them in the Prometheus text format. MetricsServer serves them on http://<host>:<port>/metrics from a
+background thread, so any Prometheus server (or curl) can scrape the gateway :
+
+    metrics = Metrics()
+    metrics.inc('mqtt_messages_total', topic='cmd')
+    metrics.observe('modbus_request_seconds', 0.004, unit=3, op='read')
+    metrics.gauge('dispatch_queue_depth', dispatcher.queue_depth)
+    MetricsServer(metrics, port=9105).start()
+
+Recording a value is a dict update under a lock, cheap enough to do for every message.
+
+SampledLog writes one JSON object per line instead of free text, and of the frequent events it only writes one in
+sample_every, with the number of events it stood for. Warnings and errors are always written.
+'''
+
+import bisect
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+import logging
+log = logging.getLogger(__name__)
+
+#upper bounds in seconds of the histogram buckets, from a fast local slave to a timed out request
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _labels(labels):
+	return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _format(name, labels, extra=()):
+	pairs = list(labels) + list(extra)
+	if not pairs:
+		return name
+	return '%s{%s}' % (name, ','.join('%s="%s"' % (key, value.replace('\\', '\\\\').replace('"', '\\"')) for key, value in pairs))
+
+
+def _number(value):
+	return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metrics(object):
+
+	def __init__(self, buckets=LATENCY_BUCKETS):
+		self.buckets = tuple(buckets)
+		self._lock = threading.Lock()
+		self._counters = {} 			#name -> {labels -> value}
+		self._histograms = {} 			#name -> {labels -> [bucket counts..., sum, count]}
+		self._functions = {} 			#name -> (type, {labels -> function returning the value})
+
+	#adds amount to counter name.
+	def inc(self, name, amount=1, **labels):
+		key = _labels(labels)
+		with self._lock:
+			values = self._counters.setdefault(name, {})
+			values[key] = values.get(key, 0) + amount
+
+	#records one value (a duration in seconds) in histogram name.
+	def observe(self, name, value, **labels):
+		key = _labels(labels)
+		index = bisect.bisect_left(self.buckets, value)
+		with self._lock:
+			values = self._histograms.setdefault(name, {})
+			counts = values.get(key)
+			if counts is None:
+				counts = values[key] = [0] * (len(self.buckets) + 3)
+			counts[index] += 1 			#index len(buckets) is the +Inf bucket
+			counts[-2] += value
+			counts[-1] += 1
+
+	#registers gauge name, whose value is read from function when the metrics are rendered.
+	def gauge(self, name, function, **labels):
+		self._register(name, 'gauge', function, labels)
+
+	#registers counter name kept by someone else, e.g. a count attribute of the connection pool, read from function.
+	def counter(self, name, function, **labels):
+		self._register(name, 'counter', function, labels)
+
+	def _register(self, name, kind, function, labels):
+		with self._lock:
+			self._functions.setdefault(name, (kind, {}))[1][_labels(labels)] = function
+
+	#returns the value of counter name, 0 if it was never incremented.
+	def count(self, name, **labels):
+		with self._lock:
+			return self._counters.get(name, {}).get(_labels(labels), 0)
+
+	#renders every metric in the Prometheus text exposition format.
+	def render(self):
+		with self._lock:
+			counters = dict((name, dict(values)) for name, values in self._counters.items())
+			histograms = dict((name, dict((key, list(counts)) for key, counts in values.items())) for name, values in self._histograms.items())
+			functions = dict((name, (kind, dict(values))) for name, (kind, values) in self._functions.items())
+		lines = []
+		for name in sorted(counters):
+			lines.append('# TYPE %s counter' % name)
+			for key, value in sorted(counters[name].items()):
+				lines.append('%s %s' % (_format(name, key), _number(value)))
+		for name in sorted(functions):
+			kind, values = functions[name]
+			lines.append('# TYPE %s %s' % (name, kind))
+			for key, function in sorted(values.items(), key=lambda item: item[0]):
+				try:
+					value = function()
+				except Exception:
+					log.exception("Reading %s failed", name)
+					continue
+				lines.append('%s %s' % (_format(name, key), _number(value)))
+		for name in sorted(histograms):
+			lines.append('# TYPE %s histogram' % name)
+			for key, counts in sorted(histograms[name].items()):
+				cumulative = 0
+				for bound, count in zip(self.buckets + ('+Inf',), counts):
+					cumulative += count
+					lines.append('%s %d' % (_format(name + '_bucket', key, [('le', str(bound))]), cumulative))
+				lines.append('%s %s' % (_format(name + '_sum', key), _number(counts[-2])))
+				lines.append('%s %d' % (_format(name + '_count', key), counts[-1]))
+		return '\n'.join(lines) + '\n'
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+	daemon_threads = True
+
+
+#-----------------------------------------------------------------------------------------------------------------------#
+# Serves metrics.render() on /metrics over HTTP from a background thread. Port 0 picks a free port, see self.port.
+#-----------------------------------------------------------------------------------------------------------------------#
+class MetricsServer(object):
+
+	def __init__(self, metrics, host='127.0.0.1', port=9105):
+		metrics_ = metrics
+
+		class Handler(BaseHTTPRequestHandler):
+			def do_GET(self):
+				if self.path.split('?')[0] != '/metrics':
+					self.send_error(404)
+					return
+				body = metrics_.render().encode('utf-8')
+				self.send_response(200)
+				self.send_header('Content-Type', 'text/plain; version=0.0.4')
+				self.send_header('Content-Length', str(len(body)))
+				self.end_headers()
+				self.wfile.write(body)
+
+			def log_message(self, format, *args): 	#no line per scrape
+				pass
+
+		self._server = _ThreadingHTTPServer((host, port), Handler)
+		self.port = self._server.server_address[1]
+		self._thread = threading.Thread(target=self._server.serve_forever, name="MetricsServer")
+		self._thread.daemon = True
+
+	def start(self):
+		self._thread.start()
+
+	def stop(self):
+		self._server.shutdown()
+		self._server.server_close()
+
+
+class SampledLog(object):
+
+	#-----------------------------------------------------------------------------------------------------------------#
+	# logger       - logging.Logger the lines are written to.
+	# sample_every - of the events logged with info() or debug(), one in sample_every per event name is written.
+	#                1 writes all of them.
+	#-----------------------------------------------------------------------------------------------------------------#
+	def __init__(self, logger, sample_every=100):
+		self.logger = logger
+		self.sample_every = max(1, int(sample_every))
+		self._lock = threading.Lock()
+		self._seen = {} 			#event name -> events since the last one written, the first one is always written
+
+	def debug(self, event, **fields):
+		self._sampled(logging.DEBUG, event, fields)
+
+	def info(self, event, **fields):
+		self._sampled(logging.INFO, event, fields)
+
+	#rare events such as config changes, always written.
+	def event(self, event, **fields):
+		self._write(logging.INFO, event, fields)
+
+	def warning(self, event, **fields):
+		self._write(logging.WARNING, event, fields)
+
+	def error(self, event, **fields):
+		self._write(logging.ERROR, event, fields)
+
+	def _sampled(self, level, event, fields):
+		if not self.logger.isEnabledFor(level):
+			return
+		with self._lock:
+			seen = self._seen.get(event, 0)
+			self._seen[event] = (seen + 1) % self.sample_every
+		if seen:
+			return
+		if self.sample_every > 1:
+			fields['sampled'] = self.sample_every 	#this line stands for up to that many events
+		self._write(level, event, fields, stacklevel=4)
+
+	#stacklevel makes the module and line of the line written those of the caller of debug(), event(), ...
+	def _write(self, level, event, fields, stacklevel=3):
+		if self.logger.isEnabledFor(level):
+			fields['event'] = event
+			fields['ts'] = round(time.time(), 3)
+			self.logger.log(level, json.dumps(fields, default=str, sort_keys=True), stacklevel=stacklevel)
@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+'''
+Minimal in-process MQTT 3.1.1 broker, used by benchmark.py so the gateway can be measured offline.
+
+It supports what the gateway and the remote client use : CONNECT, SUBSCRIBE/UNSUBSCRIBE with + and # wildcards,
+PUBLISH at QoS 0, 1 and 2, retained messages, will messages, keep alive pings and shared subscriptions
+($share/<group>/<filter>, each message goes to one subscriber of the group in turn). Messages are delivered to
+subscribers at QoS 0 or 1 (QoS 2 subscriptions are granted QoS 1). There is no persistence, authentication or
+session state across connections. It is a test stand-in and not meant to replace a real broker.
+
+    broker = MiniBroker(port=0) 	#0 picks a free port
+    broker.start()
+    print(broker.port)
+    ...
+    broker.stop()
+
+It can also be run on its own : python mini_broker.py --port 1883
+'''
+
+import asyncio
+import struct
+import threading
+
+import logging
+log = logging.getLogger(__name__)
+
+CONNECT, CONNACK, PUBLISH, PUBACK, PUBREC, PUBREL, PUBCOMP = 1, 2, 3, 4, 5, 6, 7
+SUBSCRIBE, SUBACK, UNSUBSCRIBE, UNSUBACK, PINGREQ, PINGRESP, DISCONNECT = 8, 9, 10, 11, 12, 13, 14
+
+
+#returns True if topic matches the subscription filter, which may hold + and # wildcards.
+def topic_matches(topic_filter, topic):
+	filter_levels = topic_filter.split('/')
+	topic_levels = topic.split('/')
+	if topic.startswith('$') and not topic_filter.startswith('$'):
+		return False
+	for i, level in enumerate(filter_levels):
+		if level == '#':
+			return True
+		if i >= len(topic_levels) or (level != '+' and level != topic_levels[i]):
+			return False
+	return len(filter_levels) == len(topic_levels)
+
+
+def _encode_string(text):
+	data = text.encode('utf-8')
+	return struct.pack('>H', len(data)) + data
+
+
+def _packet(packet_type, flags, body):
+	length = len(body)
+	header = bytearray([(packet_type << 4) | flags])
+	while True:
+		byte = length % 128
+		length //= 128
+		header.append(byte | 0x80 if length else byte)
+		if not length:
+			return bytes(header) + body
+
+
+class _Session(object):
+
+	def __init__(self, writer):
+		self.writer = writer
+		self.client_id = None
+		self.subscriptions = {} 		#topic filter -> granted qos
+		self.will = None 				#(topic, payload, qos, retain)
+		self._packet_ids = 0
+
+	def next_packet_id(self):
+		self._packet_ids = self._packet_ids % 0xFFFF + 1
+		return self._packet_ids
+
+	def send(self, data):
+		if not self.writer.is_closing():
+			self.writer.write(data)
+
+
+class MiniBroker(object):
+
+	def __init__(self, host='127.0.0.1', port=0):
+		self.host = host
+		self.port = port
+		self._sessions = {} 			#client id -> _Session
+		self._retained = {} 			#topic -> (payload, qos)
+		self._share_turn = {} 			#(group, filter) -> number of messages delivered to the group
+		self._loop = None
+		self._server = None
+		self._thread = None
+
+	#starts the broker in a background thread and returns once it is listening. self.port then holds the actual port.
+	def start(self):
+		started = threading.Event()
+		self._thread = threading.Thread(target=self._run, args=(started,), name="MiniBroker")
+		self._thread.daemon = True
+		self._thread.start()
+		started.wait()
+
+	def stop(self):
+		self._loop.call_soon_threadsafe(self._loop.stop)
+		self._thread.join()
+
+	def _run(self, started):
+		self._loop = asyncio.new_event_loop()
+		asyncio.set_event_loop(self._loop)
+		self._server = self._loop.run_until_complete(asyncio.start_server(self._handle, self.host, self.port))
+		self.port = self._server.sockets[0].getsockname()[1]
+		started.set()
+		self._loop.run_forever()
+		self._server.close()
+		for session in list(self._sessions.values()):
+			session.writer.close() 		#ends the connection handlers, which then see the end of their stream
+		pending = asyncio.all_tasks(self._loop)
+		if pending:
+			self._loop.run_until_complete(asyncio.wait(pending, timeout=1))
+		self._loop.close()
+
+	async def _handle(self, reader, writer):
+		session = _Session(writer)
+		clean = False
+		try:
+			while True:
+				first = await reader.readexactly(1)
+				length, shift = 0, 0
+				while True:
+					byte = (await reader.readexactly(1))[0]
+					length |= (byte & 0x7F) << shift
+					shift += 7
+					if not byte & 0x80:
+						break
+				body = await reader.readexactly(length)
+				packet_type, flags = first[0] >> 4, first[0] & 0x0F
+				if packet_type == DISCONNECT:
+					clean = True
+					break
+				self._dispatch(session, packet_type, flags, body)
+		except (asyncio.IncompleteReadError, ConnectionError):
+			pass
+		except Exception:
+			log.exception("Closing connection of %s", session.client_id)
+		finally:
+			if self._sessions.get(session.client_id) is session:
+				del self._sessions[session.client_id]
+				if not clean and session.will is not None:
+					self._publish(*session.will)
+			writer.close()
+
+	def _dispatch(self, session, packet_type, flags, body):
+		if packet_type == CONNECT:
+			self._connect(session, body)
+		elif packet_type == PUBLISH:
+			qos = (flags >> 1) & 0x03
+			size, = struct.unpack_from('>H', body)
+			topic = body[2:2 + size].decode('utf-8')
+			pos = 2 + size
+			if qos:
+				packet_id = body[pos:pos + 2]
+				pos += 2
+				session.send(_packet(PUBACK if qos == 1 else PUBREC, 0, packet_id))
+			self._publish(topic, body[pos:], qos, bool(flags & 0x01))
+		elif packet_type == PUBREL:
+			session.send(_packet(PUBCOMP, 0, body[:2]))
+		elif packet_type == SUBSCRIBE:
+			self._subscribe(session, body)
+		elif packet_type == UNSUBSCRIBE:
+			pos = 2
+			while pos < len(body):
+				size, = struct.unpack_from('>H', body, pos)
+				session.subscriptions.pop(body[pos + 2:pos + 2 + size].decode('utf-8'), None)
+				pos += 2 + size
+			session.send(_packet(UNSUBACK, 0, body[:2]))
+		elif packet_type == PINGREQ:
+			session.send(_packet(PINGRESP, 0, b''))
+		#PUBACK, PUBREC and PUBCOMP from subscribers need no answer as nothing is redelivered
+
+	def _connect(self, session, body):
+		size, = struct.unpack_from('>H', body)
+		pos = 2 + size + 1 		#protocol name and level
+		flags = body[pos]
+		pos += 3 				#flags and keep alive
+		strings = []
+		for present in (True, flags & 0x04, flags & 0x04, flags & 0x80, flags & 0x40):
+			if present:
+				size, = struct.unpack_from('>H', body, pos)
+				strings.append(body[pos + 2:pos + 2 + size])
+				pos += 2 + size
+		session.client_id = strings[0].decode('utf-8') or 'anonymous-%d' % id(session)
+		if flags & 0x04:
+			session.will = (strings[1].decode('utf-8'), strings[2], (flags >> 3) & 0x03, bool(flags & 0x20))
+		old = self._sessions.get(session.client_id)
+		if old is not None:
+			old.writer.close() 			#a second connection with the same client id takes over
+		self._sessions[session.client_id] = session
+		session.send(_packet(CONNACK, 0, b'\x00\x00'))
+
+	def _subscribe(self, session, body):
+		pos = 2
+		granted = bytearray()
+		filters = []
+		while pos < len(body):
+			size, = struct.unpack_from('>H', body, pos)
+			topic_filter = body[pos + 2:pos + 2 + size].decode('utf-8')
+			qos = min(body[pos + 2 + size] & 0x03, 1)
+			pos += 3 + size
+			session.subscriptions[topic_filter] = qos
+			granted.append(qos)
+			filters.append(topic_filter)
+		session.send(_packet(SUBACK, 0, body[:2] + bytes(granted)))
+		filters = [topic_filter for topic_filter in filters if not topic_filter.startswith('$share/')] 	#no retained messages for groups
+		for topic, (payload, qos) in list(self._retained.items()):
+			for topic_filter in filters:
+				if topic_matches(topic_filter, topic):
+					self._deliver(session, topic, payload, min(qos, session.subscriptions[topic_filter]), True)
+					break
+
+	def _publish(self, topic, payload, qos, retain):
+		if retain:
+			if payload:
+				self._retained[topic] = (payload, qos)
+			else:
+				self._retained.pop(topic, None)
+		groups = {} 					#(group, filter) -> [(session, qos)]
+		for session in list(self._sessions.values()):
+			granted = []
+			for topic_filter, sub_qos in session.subscriptions.items():
+				if topic_filter.startswith('$share/'):
+					group, shared_filter = topic_filter[7:].split('/', 1)
+					if topic_matches(shared_filter, topic):
+						groups.setdefault((group, shared_filter), []).append((session, sub_qos))
+				elif topic_matches(topic_filter, topic):
+					granted.append(sub_qos)
+			if granted:
+				self._deliver(session, topic, payload, min(qos, max(granted)), False)
+		for key, members in groups.items():
+			turn = self._share_turn.get(key, 0)
+			self._share_turn[key] = turn + 1
+			session, sub_qos = members[turn % len(members)]
+			self._deliver(session, topic, payload, min(qos, sub_qos), False)
+
+	def _deliver(self, session, topic, payload, qos, retain):
+		body = _encode_string(topic)
+		if qos:
+			body += struct.pack('>H', session.next_packet_id())
+		session.send(_packet(PUBLISH, (qos << 1) | (1 if retain else 0), body + payload))
+
+
+if __name__ == '__main__':
+	import argparse
+	import time
+	parser = argparse.ArgumentParser(description="Minimal MQTT broker for offline tests")
+	parser.add_argument('--host', default='127.0.0.1')
+	parser.add_argument('--port', type=int, default=1883)
+	args = parser.parse_args()
+	broker = MiniBroker(args.host, args.port)
+	broker.start()
+	print("MQTT broker listening on %s:%d" % (args.host, broker.port))
+	while True:
+		time.sleep(3600)
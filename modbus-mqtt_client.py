@@ -12,46 +12,173 @@ Hence this implementation allows for the use of multiple MODBUS TCP slaves whose
 for each slave can also be configured by the user. Data can be read/written to these slaves from a remote MQTT client connected to iot.eclipse.org MQTT server.
 '''
 
-#importing all required methods from pymodbus for estalishing MODBUS TCP connection
-import serial
+#importing only what the gateway uses. The MODBUS clients (pymodbus, and pyserial for RTU lines) are created by modbus_endpoints.py
 import socket
-import traceback
-from pymodbus.framer.rtu_framer import ModbusRtuFramer
-from pymodbus.constants import Endian
-from pymodbus.payload import BinaryPayloadDecoder
-from pymodbus.constants import Defaults
-from pymodbus.utilities import hexlify_packets
-from pymodbus.factory import ServerDecoder
-from pymodbus.datastore import ModbusServerContext
-from pymodbus.device import ModbusControlBlock
-from pymodbus.device import ModbusDeviceIdentification
-from pymodbus.transaction import *
-from pymodbus.exceptions import NotImplementedException, NoSuchSlaveException
-from pymodbus.pdu import ModbusExceptions as merror
-from pymodbus.compat import socketserver, byte2int
-from binascii import b2a_hex
-from pymodbus.server.sync import StartTcpServer
-from pymodbus.server.sync import ModbusTcpServer 
-from pymodbus.server.sync import StartUdpServer
-from pymodbus.server.sync import StartSerialServer
-import pymodbus.server.sync
-from pymodbus.server.sync import ModbusConnectedRequestHandler
-from pymodbus.device import ModbusDeviceIdentification
-from pymodbus.datastore import ModbusSequentialDataBlock, ModbusSparseDataBlock
-from pymodbus.datastore import ModbusSlaveContext, ModbusServerContext
-from pymodbus.transaction import ModbusRtuFramer, ModbusBinaryFramer
-from pymodbus.client.sync import ModbusTcpClient as ModbusClient
+import os
+from pymodbus.exceptions import ModbusIOException
+from modbus_pool import ModbusConnectionPool
+from modbus_poller import ModbusPoller
+from gateway_core import AsyncDispatcher, DispatcherGroup, REJECT, DROP_OLDEST
+from modbus_endpoints import parse_endpoint, endpoint_text, is_serial, max_inflight, DEFAULT_INFLIGHT
+from device_table import DeviceTable, compile_table, apply_delta, device_fields, save_snapshot, load_snapshot, lock_snapshot
+from register_cache import RegisterCache
+from write_batcher import WriteBatcher
+from report_by_exception import ExceptionReporter
+from payload_codec import decode_block, decode_value, encode_value, encode_batch
+from gateway_metrics import Metrics, MetricsServer, SampledLog
+from shard_ring import HashRing, MEMBERS_TOPIC
+from store_forward import DiskRingBuffer, StoreAndForward, BufferInUseError
+from mqtt_rpc import REPLY_PREFIX
+from compact_datastore import MappedRegisters, datastore_path
 
 import paho.mqtt.client as mqtt #import the client1
 import time 					#for time delays
 
 import logging 
 import json 					#to convert reg_config and slave_config from received json format
+import threading
+import argparse
+from functools import partial
+from concurrent.futures import Future
+
+parser = argparse.ArgumentParser(description="Modbus TCP + MQTT gateway")
+parser.add_argument('--broker', default="test.mosquitto.org", help="address of the MQTT broker")
+parser.add_argument('--broker-port', type=int, default=1883)
+parser.add_argument('--modbus-host', default="localhost", help="address of the MODBUS server of devices which set no endpoint")
+parser.add_argument('--modbus-port', type=int, default=502)
+parser.add_argument('--modbus-framer', default="socket", choices=['socket', 'rtu'], help="framing used by that server, as --framer of modbus_server.py")
+parser.add_argument('--modbus-inflight', type=int, default=DEFAULT_INFLIGHT, help="requests pipelined on a connection to that server with socket framing")
+parser.add_argument('--metrics-host', default="127.0.0.1", help="address the metrics are served on, 0.0.0.0 for every interface")
+parser.add_argument('--metrics-port', type=int, default=9105, help="port of the metrics endpoint http://<host>:<port>/metrics, 0 disables it")
+parser.add_argument('--log-level', default="INFO", choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'])
+parser.add_argument('--log-sample', type=int, default=100, help="log one in this many request events, 1 logs all of them")
+parser.add_argument('--instance-id', default="GATEWAY-%s-%d" % (socket.gethostname(), os.getpid()), help="MQTT client id, unique per gateway instance")
+parser.add_argument('--shared-group', help="share the request topics with the other gateways of this group, each request is handled by one of them")
+parser.add_argument('--shard', action='store_true', help="poll only the units this instance owns on the consistent hash ring of the running gateways")
+parser.add_argument('--buffer-file', default="telemetry.buf", help="file buffering the polled values while the broker is unreachable, empty to disable")
+parser.add_argument('--buffer-size', type=int, default=16, help="size of the buffer file in MB")
+parser.add_argument('--shared-datastore', help="--datastore directory of a modbus_server.py on this host, whose registers are then read from shared memory")
+parser.add_argument('--snapshot', default="device_table.json", help="file the device table is saved to and loaded from on startup, empty to disable")
+args = parser.parse_args()
+
+#------------------------------------------------------------------------------------------------------------------------------------------------------#
+# Metrics of the hot path (see gateway_metrics.py), served on http://<metrics host>:<metrics port>/metrics :
+#     mqtt_messages_total, mqtt_handle_seconds      - messages received and time spent handling them in the MQTT thread, per topic
+#     request_seconds, request_errors_total         - time from receiving a request until it is answered, and failed requests, per path
+#     modbus_request_seconds, modbus_errors_total   - MODBUS round trip time and failed MODBUS requests, per unit and op
+#     dispatch_queue_depth                          - requests waiting for the dispatcher, per endpoint
+#     shared_reads_total                            - reads served from the shared datastore of a server on this host, per unit
+#     modbus_connects_total, mqtt_connects_total... - (re)connections to the MODBUS server and the MQTT broker
+# Request events are logged as JSON lines, one in --log-sample of them. Warnings, errors and config changes are always logged.
+#------------------------------------------------------------------------------------------------------------------------------------------------------#
+metrics = Metrics()
+slog = SampledLog(logging.getLogger('gateway'), args.log_sample)
 
 reg_config = {} 				#global variale to store reg_config as it is updated by remote mqtt client1
 slave_config = {} 				#global variable to store slave_config as it is updated by remote mqtt client1
+poll_config = {} 				#global variable to store the poll interval (seconds) of each device as it is updated by remote mqtt client1
+extra_config = {} 				#global variable to store the other fields of each device (type, ttl, deadband...) as they are updated through config_delta
+applied_configs = {} 			#config topic -> payload the device table was last compiled from, saved with the snapshot
+device_table = DeviceTable() 	#compiled from the configs above. Handlers only read it, a new version replaces it whenever a config changes.
+config_lock = threading.Lock() 	#serialises config updates
 device_in_use = '' 				#global variable which stores the name of device currently being accessed by remote mqtt client1
 
+#endpoint of the devices which do not set their own "endpoint" (e.g. "tcp://10.0.0.7:502" or "rtu:///dev/ttyUSB0?baudrate=19200", see modbus_endpoints.py)
+DEFAULT_ENDPOINT = endpoint_text('tcp://%s:%d?framer=%s' % (args.modbus_host, args.modbus_port, args.modbus_framer) +
+	('&inflight=%d' % args.modbus_inflight if args.modbus_framer == 'socket' else ''))
+
+DEFAULT_POLL_INTERVAL = 10 		#poll interval in seconds for devices missing from poll_config. 0 disables polling of those devices.
+POLL_MAX_GAP = 8 				#largest number of unused registers read to merge two devices into one block read
+
+#--------------------------------------------------------------------------------------------------------------------------------------#
+# Topics the polled values are published to, each with its encoding (see payload_codec.py) :
+#     text   - one message per device on <topic>/<device name> with the value as text
+#     json   - one message per block read on <topic>, a JSON array of [device, value, timestamp]
+#     binary - one message per block read on <topic>, struct packed points
+# e.g. {'poll': 'text', 'poll_batch': 'binary'} publishes every value both ways.
+#--------------------------------------------------------------------------------------------------------------------------------------#
+POLL_TOPICS = {'poll': 'text'}
+
+#--------------------------------------------------------------------------------------------------------------------------------------#
+# MODBUS requests do not run in the MQTT thread. They are queued on the dispatcher of their endpoint, which runs at most UNIT_CONCURRENCY
+# requests per slave unit at a time and fails requests which take longer than REQUEST_TIMEOUT seconds (queueing included). When
+# DISPATCH_QUEUE_SIZE requests are waiting, new requests are rejected (REJECT) or the oldest waiting request is dropped (DROP_OLDEST).
+# Every endpoint has its own queue and ENDPOINT_WORKERS threads, a serial line a single one, so a dead PLC or a slow RTU line only delays
+# its own requests. An endpoint pipelining its requests (MBAP framing, see modbus_endpoints.py) gets one thread per request it takes in
+# flight, against any of its units, so a remote PLC behind a slow link is kept as busy as the link allows.
+#--------------------------------------------------------------------------------------------------------------------------------------#
+DISPATCH_QUEUE_SIZE = 1000
+UNIT_CONCURRENCY = 1
+REQUEST_TIMEOUT = 5
+OVERFLOW_POLICY = REJECT
+ENDPOINT_WORKERS = 8
+modbus_pool = ModbusConnectionPool(max_idle=ENDPOINT_WORKERS) 	#long lived MODBUS connections, one idle per thread of an endpoint so none is reopened
+
+#creates the dispatcher of endpoint the first time a request is sent to it.
+def make_dispatcher(endpoint):
+	inflight = max_inflight(endpoint)
+	if inflight > 1:
+		workers, unit_limit = inflight, inflight
+	else:
+		workers, unit_limit = 1 if is_serial(endpoint) else ENDPOINT_WORKERS, UNIT_CONCURRENCY
+	dispatcher = AsyncDispatcher(max_queue=DISPATCH_QUEUE_SIZE, unit_limit=unit_limit, timeout=REQUEST_TIMEOUT, overflow=OVERFLOW_POLICY,
+		workers=workers)
+	metrics.gauge('dispatch_queue_depth', dispatcher.queue_depth, endpoint=endpoint)
+	return dispatcher
+
+dispatchers = DispatcherGroup(make_dispatcher)
+
+DEFAULT_CACHE_TTL = 1 			#seconds a value read from a device is served from the cache, unless the device sets its own ttl. 0 disables caching.
+CACHE_SIZE = 10000 				#number of register values kept in the cache, least recently used ones are evicted first
+register_cache = RegisterCache(max_entries=CACHE_SIZE)
+
+WRITE_WINDOW_MS = 20 			#writes are collected for this many milliseconds, then adjacent registers of a unit are written in one request
+
+#--------------------------------------------------------------------------------------------------------------------------------------#
+# Shared datastore. When modbus_server.py runs on this host with --datastore DIR and the gateway with --shared-datastore DIR, the devices
+# of the default endpoint are read straight from the memory mapped register files of the server (see compact_datastore.py), with no
+# socket or framing in between. Writes still go to the server. A unit without a file of its own is read from the file of unit 0, which
+# a server serving one context for every unit writes. A unit without any file is looked for again after SHARED_RETRY seconds.
+#--------------------------------------------------------------------------------------------------------------------------------------#
+SHARED_RETRY = 10
+shared_files = {} 				#unit -> (MappedRegisters or None, time to look for the file again)
+
+#--------------------------------------------------------------------------------------------------------------------------------------#
+# Store and forward (see store_forward.py). Polled values published while the broker is unreachable go to --buffer-file, a ring of
+# --buffer-size MB which drops the oldest values when full (BUFFER_OVERFLOW, or REJECT to drop the newest). After reconnecting they are
+# replayed on the backfill topic with their original topic and timestamp, REPLAY_BATCH values per message and at most REPLAY_RATE per second.
+#--------------------------------------------------------------------------------------------------------------------------------------#
+BUFFER_OVERFLOW = DROP_OLDEST
+REPLAY_RATE = 500
+REPLAY_BATCH = 100
+
+#--------------------------------------------------------------------------------------------------------------------------------------#
+# Report by exception. When REPORT_BY_EXCEPTION is True a polled value is only published to poll/<device> when it moved more than the
+# deadband of the device since the last published value, at most once every min_interval seconds, and at least every max_age seconds.
+# A device can set its own deadband (e.g. 0.5 or "2%"), min_interval and max_age through config_delta.
+#--------------------------------------------------------------------------------------------------------------------------------------#
+REPORT_BY_EXCEPTION = True
+DEFAULT_DEADBAND = 0 			#publish any change
+DEFAULT_MIN_PUBLISH_INTERVAL = 0
+DEFAULT_MAX_AGE = 300 			#heartbeat every 5 minutes. 0 disables the heartbeat.
+reporter = ExceptionReporter()
+
+#------------------------------------------------------------------------------------------------------------------------------------------------------#
+# Scale out. Any number of gateways can run against the same broker, each with its own --instance-id.
+# With --shared-group the request topics of SHARED_TOPICS are subscribed as $share/<group>/<topic>, so the broker hands every request to one
+# gateway of the group. device_in_use stays a normal subscription, every gateway keeps track of it for a data message it may receive.
+# With --shard the gateways announce themselves on gateway/members/<instance id> and each polls only the units it owns on the hash ring of
+# the announced members (see shard_ring.py). A gateway joining or leaving moves about 1/N of the units.
+#------------------------------------------------------------------------------------------------------------------------------------------------------#
+INSTANCE_ID = args.instance_id
+SHARED_TOPICS = ('data', 'read_req', 'cmd')
+members = set() 				#instance ids of the announced gateways
+shard_ring = HashRing([INSTANCE_ID])
+
+#field values of devices which do not set them themselves
+DEVICE_DEFAULTS = {'interval': DEFAULT_POLL_INTERVAL, 'ttl': DEFAULT_CACHE_TTL, 'deadband': DEFAULT_DEADBAND,
+	'min_interval': DEFAULT_MIN_PUBLISH_INTERVAL, 'max_age': DEFAULT_MAX_AGE, 'endpoint': DEFAULT_ENDPOINT}
+
 
 #-----------------------------------------------------------------------------------------------------------------------------------------------------------#
 # device_in_use variable has the key(name) of the device which is currently being accessed. This is set when data is written when user selects the device.
@@ -60,7 +187,7 @@ device_in_use = '' 				#global variable which stores the name of device currentl
 def device_in_use_on_message(client, userdata, message):
 	global device_in_use 				#to specifiy that the global variable is being referenced.
 	device_in_use = message.payload
-	print("Device in use ",device_in_use)
+	slog.info('device_in_use', device=device_in_use.decode("utf-8", "replace"))
 
 	
 #-------------------------------------------------------------------------------------------------------------------------------------------------------------#
@@ -72,29 +199,245 @@ def data_on_message(client, userdata, message):
 	global device_in_use 
 	diu1 = device_in_use.decode("utf-8") #to convert from binary array to string
 	topic = message.topic
-	value = int(message.payload) #Converting the bytearray to integer value.
-	print('Data received.')
-	print('Value :',value)
-	reg = int(reg_config[locals()['diu1']])
-	UNIT = int(slave_config[locals()['diu1']])
-	print("Register to write into :\n")
-	print(reg)
-	print("Slave unit to write into :\n")
-	print(UNIT)
-	mclient = ModbusClient(host = "localhost", port = 502, framer = ModbusRtuFramer) #Initialise the ModbusTcpClient
-	mclient.connect()
-	rw = mclient.write_register(reg,value,unit=UNIT)
-	mclient.close()	
+	value = float(message.payload) #Converting the bytearray to a number. It is encoded into the data type of the device on writing.
+	slog.info('write', device=diu1, value=value)
+	submit_write(diu1, value).add_done_callback(partial(data_done, diu1, time.perf_counter()))
+
+#reports a failed write of data_on_message. Called by the dispatcher once the write is done.
+def data_done(device, start, future):
+	request_done('data', start, future, device)
+
+#records the latency of a request of path received at start (perf_counter) and logs it if it failed.
+def request_done(path, start, future, device=None, **fields):
+	metrics.observe('request_seconds', time.perf_counter() - start, path=path)
+	if future.exception() is not None:
+		metrics.inc('request_errors_total', path=path, error=type(future.exception()).__name__)
+		slog.warning('request_failed', path=path, device=device, error=str(future.exception()) or type(future.exception()).__name__, **fields)
+
+#------------------------------------------------------------------------------------------------------------------------------------------------------#
+# Runs request(mclient) on a pooled connection to endpoint and returns its response. Its round trip time is recorded per endpoint, unit and op,
+# and a failed request is counted and raised as ModbusIOException.
+#------------------------------------------------------------------------------------------------------------------------------------------------------#
+def modbus_call(endpoint, unit, op, request):
+	start = time.perf_counter()
+	try:
+		with modbus_pool.endpoint_connection(parse_endpoint(endpoint)) as mclient: #Reuses an open connection to the endpoint
+			response = request(mclient)
+		if response.isError():
+			raise ModbusIOException(str(response))
+		return response
+	except Exception as e:
+		metrics.inc('modbus_errors_total', endpoint=endpoint, unit=unit, op=op, error=type(e).__name__)
+		raise
+	finally:
+		metrics.observe('modbus_request_seconds', time.perf_counter() - start, endpoint=endpoint, unit=unit, op=op)
+
+#-------------------------------------------------------------------------------------------------------------------------------------------#
+# Looks device up in the device table and queues fn(Device, *args) on the dispatcher of its endpoint against its slave unit. Returns the future of the
+# request, so the MQTT thread never waits for a MODBUS reply. An unknown device gives a future which has already failed.
+#-------------------------------------------------------------------------------------------------------------------------------------------#
+def submit_device(device, fn, *args):
+	dev = device_table.get(device)
+	if dev is None:
+		future = Future()
+		future.set_exception(ValueError("Unknown device " + device))
+		return future
+	return dispatchers.submit(dev.endpoint, dev.unit, fn, dev, *args)
+
+#key of the value of dev in the register cache. Cached values are decoded, so devices reading the same registers as another type, scale or
+#byte order have their own entries.
+def cache_key(dev):
+	return (dev.endpoint, dev.unit, dev.register, dev.dtype, dev.scale, dev.byte_order, dev.word_order)
+
+#-------------------------------------------------------------------------------------------------------------------------------------------#
+# Reads device through the register cache. Returns a future with the value, taken from the cache if it is younger than the ttl of the
+# device. Identical reads arriving while one is in flight share its future, so only one MODBUS read goes out.
+#-------------------------------------------------------------------------------------------------------------------------------------------#
+def submit_read(device):
+	dev = device_table.get(device)
+	if dev is None:
+		return submit_device(device, read_device) 		#fails with unknown device
+	return register_cache.read(cache_key(dev), dev.ttl, partial(load_device, dev))
+
+#starts the read of dev, from the shared datastore when the server of dev shares it, else through the dispatcher of its endpoint.
+def load_device(dev):
+	registers = shared_read(dev.endpoint, dev.unit, dev.register, dev.count)
+	if registers is None:
+		return submit_device(dev.name, read_device)
+	future = Future()
+	try:
+		future.set_result(decode_value(dev, registers))
+	except Exception as e:
+		future.set_exception(e)
+	return future
+
+#reads the registers of dev from the MODBUS server and returns its value, decoded with the data type and scale of dev.
+def read_device(dev):
+	rr = modbus_call(dev.endpoint, dev.unit, 'read', lambda mclient: mclient.read_holding_registers(dev.register,dev.count,unit=dev.unit))
+	return decode_value(dev, rr.registers)
+
+#-------------------------------------------------------------------------------------------------------------------------------------------#
+# Encodes value into the registers of device and queues them on the write batcher. Returns a future resolved with the value which ended up
+# in the device (a later write to the same register within the window wins). The cache then holds that value, or nothing if the write failed.
+#-------------------------------------------------------------------------------------------------------------------------------------------#
+def submit_write(device, value):
+	dev = device_table.get(device)
+	if dev is None:
+		return submit_device(device, write_block) 		#fails with unknown device
+	ack = Future()
+	try:
+		registers = encode_value(dev, value)
+	except ValueError as e:
+		ack.set_exception(e)
+		return ack
+	write_batcher.write_registers((dev.endpoint, dev.unit), dev.register, registers).add_done_callback(partial(write_done, dev, ack))
+	return ack
+
+def write_done(dev, ack, future):
+	if future.exception() is None:
+		value = decode_value(dev, future.result())
+		register_cache.put(cache_key(dev), value, dev.ttl)
+		ack.set_result(value)
+	else:
+		register_cache.invalidate(cache_key(dev))
+		ack.set_exception(future.exception())
+
+#-------------------------------------------------------------------------------------------------------------------------------------------#
+# Returns count holding registers of unit from register, read from the shared datastore. None if endpoint is not the server sharing it,
+# or the registers are not in its files, and the request has to go to the server.
+#-------------------------------------------------------------------------------------------------------------------------------------------#
+def shared_read(endpoint, unit, register, count):
+	if not args.shared_datastore or endpoint != DEFAULT_ENDPOINT:
+		return None
+	registers, retry = shared_files.get(unit, (None, 0))
+	if registers is None:
+		if time.monotonic() < retry:
+			return None
+		registers = open_shared(unit)
+		shared_files[unit] = (registers, time.monotonic() + SHARED_RETRY)
+		if registers is None:
+			return None
+	try:
+		values = registers.read(register, count)
+	except (OSError, ValueError): 		#outside the file or the file is gone, the server gives the answer
+		return None
+	metrics.inc('shared_reads_total', unit=unit)
+	return values
+
+def open_shared(unit):
+	for path in (datastore_path(args.shared_datastore, unit, 'hr'), datastore_path(args.shared_datastore, 0, 'hr')):
+		try:
+			return MappedRegisters(path)
+		except (OSError, ValueError):
+			pass
+	slog.warning('shared_datastore_missing', unit=unit, path=args.shared_datastore)
+	return None
+
+#the write batcher and the poller group requests per slave, which here is (endpoint, unit).
+def submit_write_block(slave, start, values):
+	endpoint, unit = slave
+	return dispatchers.submit(endpoint, unit, write_block, endpoint, unit, start, values)
+
+#writes values into the registers of unit from start on. A single register is written with write_register, a run with write_registers.
+def write_block(endpoint, unit, start, values):
+	if len(values) == 1:
+		modbus_call(endpoint, unit, 'write', lambda mclient: mclient.write_register(start,values[0],unit=unit))
+	else:
+		modbus_call(endpoint, unit, 'write_block', lambda mclient: mclient.write_registers(start,values,unit=unit))
+
+#compiles the configs into a new device table and swaps it in. Must be called with config_lock held.
+def rebuild_table():
+	global device_table
+	table = compile_table(reg_config, slave_config, poll_config, extra_config, DEVICE_DEFAULTS, device_table.version + 1)
+	reset_changed(device_table, table)
+	device_table = table
+	table_swapped(table)
+
+#forgets the last published value of the devices changed or removed from old to new, so a value is not held to the deadband of an old config.
+def reset_changed(old, new):
+	for name, dev in old.devices.items():
+		if new.get(name) != dev:
+			reporter.reset(name)
+
+#announces a new device table version on config_version, so whoever changed the config knows when it is in use, and saves its snapshot.
+def table_swapped(table):
+	slog.event('device_table', version=table.version, devices=len(table))
+	client_gw.publish('config_version', table.version, qos=1, retain=True)
+	if args.snapshot:
+		try:
+			save_snapshot(table, args.snapshot, applied_configs)
+		except OSError as e:
+			slog.warning('snapshot_failed', path=args.snapshot, error=str(e))
+
+#copies the fields given to dev into the configs, so that rebuilding the table from them keeps the device as it is.
+def mirror_device(dev):
+	fields = device_fields(dev)
+	reg_config[dev.name], slave_config[dev.name] = fields.pop('register'), fields.pop('unit')
+	if 'interval' in fields:
+		poll_config[dev.name] = fields.pop('interval')
+	else:
+		poll_config.pop(dev.name, None)
+	extra_config[dev.name] = fields
+
+#----------------------------------------------------------------------------------------------------------------------------------------#
+# True for a retained config the device table was already compiled from. The broker sends it again on every (re)connect, and applying
+# it once more would undo the deltas applied since, e.g. after a restart from the snapshot. Must be called with config_lock held.
+#----------------------------------------------------------------------------------------------------------------------------------------#
+def config_applied(message):
+	return message.retain and applied_configs.get(message.topic) == message.payload.decode('utf-8', 'replace')
+
+#---------------------------------------------------------------------------------------------------------------------------------------#
+# Loads the device table saved by the last run from --snapshot, so requests are served and devices polled straight after a restart,
+# before any config arrives. Retained reg_config/slave_config/poll_config messages on the broker then update it, unless the table was
+# already compiled from them.
+#---------------------------------------------------------------------------------------------------------------------------------------#
+def load_device_table():
+	global device_table
+	try:
+		table, configs = load_snapshot(args.snapshot, DEVICE_DEFAULTS)
+	except FileNotFoundError:
+		return
+	except (OSError, ValueError) as e:
+		slog.warning('snapshot_invalid', path=args.snapshot, error=str(e))
+		return
+	with config_lock:
+		for dev in table.devices.values():
+			mirror_device(dev)
+		applied_configs.update(configs)
+		device_table = table
+	slog.event('snapshot_loaded', path=args.snapshot, version=table.version, devices=len(table))
+
+#------------------------------------------------------------------------------------------------------------------------------------------#
+# Opens the connection to every endpoint of the device table and starts its dispatcher, one endpoint per thread, while the MQTT client
+# connects. The first requests then do not wait for connection handshakes one after another.
+#------------------------------------------------------------------------------------------------------------------------------------------#
+def warm_up_endpoints():
+	for endpoint in set(dev.endpoint for dev in device_table.devices.values()):
+		thread = threading.Thread(target=warm_up, args=(endpoint,), name="WarmUp")
+		thread.daemon = True
+		thread.start()
+
+def warm_up(endpoint):
+	dispatchers.get(endpoint)
+	try:
+		with modbus_pool.endpoint_connection(parse_endpoint(endpoint)):
+			pass
+	except Exception as e:
+		slog.warning('endpoint_unreachable', endpoint=endpoint, error=str(e))
 
 #----------------------------------------------------------------------------------------------------------#
 # This method updates reg_config global variable when the reg_config is updated by remote mqtt client1 
 # so that data_on_message and read_req_on_message read and write from correct register.
 #----------------------------------------------------------------------------------------------------------#
 def reg_config_on_message(client, userdata, message):
-	print("reg_config received\n")
 	global reg_config 							#referring to global variable reg_config. 
-	reg_config = json.loads(message.payload) 	#converting from json data
-	print(reg_config)
+	with config_lock:
+		if config_applied(message):
+			return
+		reg_config = json.loads(message.payload) 	#converting from json data
+		applied_configs[message.topic] = message.payload.decode('utf-8', 'replace')
+		rebuild_table()
+	slog.event('reg_config', config=reg_config)
 	
 
 #----------------------------------------------------------------------------------------------------------#
@@ -102,10 +445,128 @@ def reg_config_on_message(client, userdata, message):
 # so that data_on_message and read_req_on_message read and write from correct slave unit.
 #----------------------------------------------------------------------------------------------------------#
 def slave_config_on_message(client,userdata,message):
-	print("slave_config received")
 	global slave_config 						#referring to global variable slave_config. 
-	slave_config = json.loads(message.payload)	#converting from json data
-	print(slave_config)
+	with config_lock:
+		if config_applied(message):
+			return
+		slave_config = json.loads(message.payload)	#converting from json data
+		applied_configs[message.topic] = message.payload.decode('utf-8', 'replace')
+		rebuild_table()
+	slog.event('slave_config', config=slave_config)
+
+#----------------------------------------------------------------------------------------------------------#
+# This method updates poll_config global variable when the poll_config is updated by remote mqtt client1 
+# so that the poller reads every device at the requested interval.
+#----------------------------------------------------------------------------------------------------------#
+def poll_config_on_message(client,userdata,message):
+	global poll_config 							#referring to global variable poll_config. 
+	with config_lock:
+		if config_applied(message):
+			return
+		poll_config = json.loads(message.payload)	#converting from json data
+		applied_configs[message.topic] = message.payload.decode('utf-8', 'replace')
+		rebuild_table()
+	slog.event('poll_config', config=poll_config)
+
+#-------------------------------------------------------------------------------------------------------------------------------------------#
+# This method applies a partial config change received on config_delta (see device_table.py for the format) without republishing the
+# full configs. Only the devices named in the delta are parsed. The configs are updated as well so a later full config stays in line.
+#-------------------------------------------------------------------------------------------------------------------------------------------#
+def config_delta_on_message(client, userdata, message):
+	global device_table
+	try:
+		delta = json.loads(message.payload)
+	except ValueError:
+		slog.warning('invalid_config_delta', payload=message.payload)
+		return
+	with config_lock:
+		try:
+			table = apply_delta(device_table, delta, DEVICE_DEFAULTS)
+		except (ValueError, TypeError, AttributeError) as e:
+			slog.warning('invalid_config_delta', error=str(e))
+			return
+		for name in delta.get('remove', []):
+			for config in (reg_config, slave_config, poll_config, extra_config):
+				config.pop(name, None)
+		for name in list(delta.get('add', {})) + list(delta.get('update', {})):
+			dev = table.get(name)
+			if dev is not None:
+				mirror_device(dev)
+		reset_changed(device_table, table)
+		device_table = table
+		table_swapped(table)
+
+#-------------------------------------------------------------------------------------------------------------------------------------------#
+# A gateway joined (payload online) or left (empty payload, cleared by itself or by its will) gateway/members. The hash ring is rebuilt,
+# and the poller picks up the new share of units on its next cycle. This instance is always on the ring.
+#-------------------------------------------------------------------------------------------------------------------------------------------#
+def members_on_message(client, userdata, message):
+	global shard_ring
+	instance = message.topic[len(MEMBERS_TOPIC) + 1:]
+	if message.payload:
+		members.add(instance)
+	else:
+		members.discard(instance)
+	shard_ring = HashRing(members | {INSTANCE_ID})
+	slog.event('members', members=sorted(shard_ring.members))
+
+#----------------------------------------------------------------------------------------------------------------------------------#
+# Polling. The poller calls poll_points every cycle to get the devices to read, starts merged block reads of the due ones through
+# poll_read_block, each on the dispatcher of its endpoint, and hands every block to poll_publish as soon as it is read. poll_publish decodes
+# all its values in one pass and publishes them to every topic of POLL_TOPICS in the encoding of that topic.
+#----------------------------------------------------------------------------------------------------------------------------------#
+def poll_points():
+	ring = shard_ring
+	return [(dev.name, (dev.endpoint, dev.unit), dev.register, dev.count, dev.interval) for dev in device_table.devices.values()
+		if not args.shard or ring.owner('%s#%d' % (dev.endpoint, dev.unit)) == INSTANCE_ID]
+
+def poll_read_block(slave, start, count):
+	endpoint, unit = slave
+	registers = shared_read(endpoint, unit, start, count)
+	if registers is not None:
+		future = Future()
+		future.set_result(registers)
+		return future
+	future = dispatchers.submit(endpoint, unit, read_block, endpoint, unit, start, count)
+	future.add_done_callback(partial(request_done, 'poll', time.perf_counter()))
+	return future
+
+def read_block(endpoint, unit, start, count):
+	return modbus_call(endpoint, unit, 'read_block', lambda mclient: mclient.read_holding_registers(start, count, unit=unit)).registers
+
+def poll_publish(registers, members):
+	points = []
+	for device, offset in members:
+		dev = device_table.get(device)
+		if dev is not None and offset + dev.count <= len(registers): 	#skips devices whose config changed since the read was planned
+			points.append((offset, dev))
+	if not points:
+		return
+	now = time.time()
+	mono = time.monotonic()
+	report = []
+	for (offset, dev), value in zip(points, decode_block(registers, points)):
+		register_cache.put(cache_key(dev), value, dev.ttl) 	#a polled value is as fresh as a read one
+		if REPORT_BY_EXCEPTION and not reporter.should_report(dev, value, mono):
+			continue
+		report.append((dev.name, value, now))
+	metrics.inc('poll_values_total', len(points))
+	metrics.inc('poll_values_published_total', len(report))
+	if not report:
+		return
+	for topic, encoding in POLL_TOPICS.items():
+		if encoding == 'text':
+			for device, value, ts in report:
+				publish_telemetry(topic + '/' + device, value)
+		else:
+			publish_telemetry(topic, encode_batch(report, encoding))
+
+#publishes a polled value, through the store and forward buffer when there is one.
+def publish_telemetry(topic, payload):
+	if telemetry is not None:
+		telemetry.publish(topic, payload, qos=0)
+	else:
+		client_gw.publish(topic, payload, qos=0)
 
 #---------------------------------------------------------------------------------------------------------------------------------------------------#
 # This method is called when data read request is sent from remote mqtt client1. 
@@ -116,23 +577,69 @@ def slave_config_on_message(client,userdata,message):
 
 #Method to call when requested data is published. Used as a confirmation that data has been published. 
 def data_req_on_publish(client, userdata, mid):
-	print("Data request published\n")
+	metrics.inc('mqtt_published_total')
 
 def req_response_on_connect(client, userdata, flags, rc):
-	print("Connection established.")
+	metrics.inc('mqtt_connects_total')
+	slog.event('mqtt_connected', broker=broker_address, rc=rc)
+
+def req_response_on_disconnect(client, userdata, rc):
+	if telemetry is not None:
+		telemetry.disconnected()
+	metrics.inc('mqtt_disconnects_total')
+	slog.warning('mqtt_disconnected', broker=broker_address, rc=rc)
 	
 def read_req_on_message(client,userdata,message):
-	print("Data read request received")
 	diu1 = message.payload.decode("utf-8")
-	print("Reading data from ",diu1)
-	reg = int(reg_config[locals()['diu1']])
-	UNIT = int(slave_config[locals()['diu1']])
-	mclient = ModbusClient(host = "localhost", port = 502, framer = ModbusRtuFramer) #Initialise the ModbusTcpClient
-	mclient.connect()
-	rr = mclient.read_holding_registers(reg,1,unit=UNIT)
-	value = rr.registers
-	print(value)
-	client.publish('data_req',value[0],qos=2) #published to data_req to which user client is subscribed. 
+	slog.info('read', device=diu1)
+	submit_read(diu1).add_done_callback(partial(read_req_done, client, diu1, time.perf_counter()))
+
+#publishes the value read for read_req_on_message. Called by the dispatcher once the read is done.
+def read_req_done(client, device, start, future):
+	request_done('read_req', start, future, device)
+	if future.exception() is None:
+		client.publish('data_req',future.result(),qos=2) #published to data_req to which user client is subscribed. 
+
+#----------------------------------------------------------------------------------------------------------------------------------------------------#
+# This method is called when a command is received on the cmd topic. A command is one self-contained JSON request, see mqtt_rpc.py :
+#     {"id": "7", "op": "read"|"write", "device": "energy_meter", "value": 42, "reply_to": "reply/P1/7"}
+# The result is published to the reply_to topic of the command with the same id, so many requests can be in flight at once. reply_to must
+# be a topic below REPLY_PREFIX, so a command cannot make the gateway publish on its config or data topics.
+#----------------------------------------------------------------------------------------------------------------------------------------------------#
+def cmd_on_message(client, userdata, message):
+	try:
+		command = json.loads(message.payload)
+		reply_to = command['reply_to']
+		if not reply_to.startswith(REPLY_PREFIX) or '+' in reply_to or '#' in reply_to:
+			raise ValueError
+	except (ValueError, KeyError, TypeError, AttributeError):
+		slog.warning('invalid_command', payload=message.payload)
+		return
+	try:
+		if command.get('op') == 'read':
+			future = submit_read(command['device'])
+		elif command.get('op') == 'write':
+			future = submit_write(command['device'], float(command['value']))
+		else:
+			raise ValueError("Unknown op " + str(command.get('op')))
+	except Exception as e:
+		future = Future()
+		future.set_exception(e)
+	path = 'cmd_' + command['op'] if command.get('op') in ('read', 'write') else 'cmd_invalid' 	#no metric series per made up op
+	future.add_done_callback(partial(cmd_done, client, reply_to, command.get('id'), command.get('device'), path, time.perf_counter()))
+
+#publishes the result of a command to its reply_to topic. Called by the dispatcher once the command is done.
+def cmd_done(client, reply_to, req_id, device, path, start, future):
+	request_done(path, start, future, device, id=req_id)
+	reply = {'id': req_id}
+	if future.exception() is None:
+		reply['ok'] = True
+		if future.result() is not None:
+			reply['value'] = future.result()
+	else:
+		reply['ok'] = False
+		reply['error'] = str(future.exception()) or type(future.exception()).__name__
+	client.publish(reply_to, json.dumps(reply), qos=1)
 #--------------------------------------------------------------------------- #
 # configure the service logging
 # --------------------------------------------------------------------------- #
@@ -140,93 +647,136 @@ FORMAT = ('%(asctime)-15s %(threadName)-15s'
           ' %(levelname)-8s %(module)-15s:%(lineno)-8s %(message)s')
 logging.basicConfig(format=FORMAT)
 log = logging.getLogger()
-log.setLevel(logging.DEBUG)
+log.setLevel(args.log_level)
 
-broker_address = "test.mosquitto.org"  #Using online mqtt broker
+broker_address = args.broker  #Using online mqtt broker test.mosquitto.org unless another broker is given
 
-#------------------------------------------------------------------------------------------------------------#
-# Creating reg_config instance. This instance subscribes to and hence receives data from topic reg_config.
-# Any changes made in reg_config by user and uploaded here and received by this client.
-# Once received, reg_config global variable is updated.
-#------------------------------------------------------------------------------------------------------------#
-print("creating reg_config instance")
-client_reg = mqtt.Client("REG")
-client_reg.on_message = reg_config_on_message
-print("connecting to broker")
-client_reg.connect(broker_address)
-client_reg.loop_start()
-print("Subscribing to reg_config")
-client_reg.subscribe('reg_config',qos=2)
+#------------------------------------------------------------------------------------------------------------------------------------------------------#
+# Topic dispatch table. The gateway uses a single MQTT session for every topic. Each topic is mapped to the method which handles its messages and
+# the QoS it is subscribed with. To handle a new topic add it here.
+#
+# reg_config    - Any changes made in reg_config by user are uploaded here. Once received, reg_config global variable is updated.
+# slave_config  - Any changes made in slave_config by user are uploaded here. Once received, slave_config global variable is updated.
+# poll_config   - Poll interval of each device. The poller reads every device on this interval and publishes the value to poll/<device name>.
+# config_delta  - Partial add/update/remove of devices. Only the devices in the delta are changed.
+# device_in_use - Whenever a request is sent by the user to read/write from a slave, the name of the slave is updated on this topic.
+# data          - Data to write into the register specified by reg_config of device_in_use and slave unit specified by slave_config.
+# read_req      - Name of the device to read. The value is read from the register specified by reg_config and published to data_req.
+# cmd           - Self-contained read/write command with a correlation id. The result is published to the reply_to topic of the command.
+# gateway/members/+ - Gateways running with --shard, see members_on_message. Only subscribed with --shard.
+#------------------------------------------------------------------------------------------------------------------------------------------------------#
+topic_handlers = {
+	'reg_config': 		(reg_config_on_message, 2),
+	'slave_config': 	(slave_config_on_message, 2),
+	'poll_config': 		(poll_config_on_message, 2),
+	'config_delta': 	(config_delta_on_message, 2),
+	'device_in_use': 	(device_in_use_on_message, 2),
+	'data': 			(data_on_message, 2),
+	'read_req': 		(read_req_on_message, 2),
+	'cmd': 				(cmd_on_message, 1),
+}
+if args.shard:
+	topic_handlers[MEMBERS_TOPIC + '/+'] = (members_on_message, 1)
+
+#returns the filter topic is subscribed with, $share/<group>/<topic> for request topics when the gateway is part of a shared group.
+def topic_filter(topic):
+	if args.shared_group and topic in SHARED_TOPICS:
+		return '$share/%s/%s' % (args.shared_group, topic)
+	return topic
+
+#---------------------------------------------------------------------------------------------------------------------------------------#
+# Wraps the handler of topic to count its messages and record how long each one holds up the MQTT thread. An exception raised by the
+# handler is logged and counted instead of ending the MQTT network loop.
+#---------------------------------------------------------------------------------------------------------------------------------------#
+def instrumented(topic, handler):
+	def on_message(client, userdata, message):
+		start = time.perf_counter()
+		try:
+			handler(client, userdata, message)
+		except Exception as e:
+			metrics.inc('mqtt_handler_errors_total', topic=topic)
+			slog.error('handler_failed', topic=topic, error=repr(e))
+		metrics.observe('mqtt_handle_seconds', time.perf_counter() - start, topic=topic)
+		metrics.inc('mqtt_messages_total', topic=topic)
+	return on_message
+
+#subscribes to every topic of topic_handlers in one request. Called on every (re)connection so subscriptions survive a broker restart.
+def gateway_on_connect(client, userdata, flags, rc):
+	client.socket().setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1) 	#replies go out at once, not after the ACK of the last PUBACK
+	req_response_on_connect(client, userdata, flags, rc)
+	client.subscribe([(topic_filter(topic), qos) for topic, (handler, qos) in topic_handlers.items()])
+	if args.shard:
+		client.publish(MEMBERS_TOPIC + '/' + INSTANCE_ID, 'online', qos=1, retain=True)
+	client.publish('config_version', device_table.version, qos=1, retain=True) 	#the version loaded from the snapshot, or the current one after a reconnect
+	if telemetry is not None:
+		telemetry.connected() 			#replays what was buffered during the outage
 
 #------------------------------------------------------------------------------------------------------------#
-# Creating slave_config instance. This instance subscribes to and hence receives data from topic slave_config.
-# Any changes made in slave_config by user and uploaded to this topic and received by this client.
-# Once received, slave_config global variable is updated.
+# Creating the gateway instance. One connection and one network loop serve every topic of topic_handlers.
+# The device table is loaded before connecting, and the MODBUS endpoints and the broker are connected in parallel.
 #------------------------------------------------------------------------------------------------------------#
-print("creating slave_config instance")
-client_slave = mqtt.Client("SLAVE")
-client_slave.on_message = slave_config_on_message
-print("connecting to broker")
-client_slave.connect(broker_address)
-client_slave.loop_start()
-print("Subscribing to slave_config")
-client_slave.subscribe('slave_config',qos=2)
-
-#--------------------------------------------------------------------------------------------------------------------------------------------------------------------------#
-# Creating device is use instance. This instance subscribes to and hence receives data from topic device_in_use.
-# Whenever a request is send by the user to read/write from a slave, the name of the slave which has been reqested is updated on this topic and received by this client.
-# Once received, device_in_use global variable is updated.
-#--------------------------------------------------------------------------------------------------------------------------------------------------------------------------#
-print("Creating device_in_use instance")
-client_diu = mqtt.Client("DIU")
-client_diu.on_message = device_in_use_on_message
-print("connecting to broker")
-client_diu.connect(broker_address)
-client_diu.loop_start()
-print("Subscribing to device_in_use")
-client_diu.subscribe('device_in_use',qos=2)
-
-#----------------------------------------------------------------------------------------------------------------------------------------------#
-# Creating data instance. This instance subscribes and hence receives data from topic data.
-# Whenever data to write into a slave is sent by the user, it is updated on this topic and received by this client.
-# Once received, it is written into the register specified by reg_config of that slave and slave unit specified by slave_config in function data_on_message.
-#----------------------------------------------------------------------------------------------------------------------------------------------#
-print("Creating data instance")
-client_data = mqtt.Client("DATA")
-client_data.on_message = data_on_message
-print("connecting to broker")
-client_data.connect(broker_address)
-client_data.loop_start()
-print("Subscribing to data")
-client_data.subscribe('data',qos=2)
-
-
-#-----------------------------------------------------------------------------------------------------------------------------------------------------#
-# Creating data request instance. This instance subscribes and hence recieves data from topic read_req.
-# Wheber data is to be read from a slave, the name of the slave to read data from is updated on this topic and hence received by this client.
-# Once received, it is read from register specified by reg_config of that slave and published to be received by user in method read_req_on_message.
-#-----------------------------------------------------------------------------------------------------------------------------------------------------#
-print("Creating data req instance")
-client_data_req = mqtt.Client("DATA_REQ")
-client_data_req.on_message = read_req_on_message
-client_data_req.on_publish = data_req_on_publish
-print("connecting to broker")
-client_data_req.connect(broker_address)
-client_data_req.loop_start()
-print("Subscribing to read req")
-client_data_req.subscribe('read_req',qos=2)
+if args.snapshot:
+	snapshot_lock = lock_snapshot(args.snapshot) 	#held while the gateway runs
+	if snapshot_lock is None:
+		slog.warning('snapshot_in_use', path=args.snapshot, hint="another gateway uses it, give every instance its own --snapshot")
+		args.snapshot = ''
+	else:
+		load_device_table()
+warm_up_endpoints()
+write_batcher = WriteBatcher(submit_write_block, window_ms=WRITE_WINDOW_MS)
+
+metrics.gauge('device_table_version', lambda: device_table.version)
+metrics.gauge('device_table_devices', lambda: len(device_table))
+metrics.counter('modbus_connects_total', lambda: modbus_pool.connects)
+metrics.counter('modbus_connect_failures_total', lambda: modbus_pool.connect_failures)
+metrics.gauge('gateway_members', lambda: len(shard_ring))
+if args.metrics_port:
+	try:
+		metrics_server = MetricsServer(metrics, args.metrics_host, args.metrics_port)
+	except OSError as e: 		#e.g. another gateway on this host has the port, this one runs without metrics
+		slog.warning('metrics_unavailable', port=args.metrics_port, error=str(e), hint="give every instance its own --metrics-port")
+	else:
+		metrics_server.start()
+		slog.event('metrics_listening', url='http://%s:%d/metrics' % (args.metrics_host, metrics_server.port))
+
+client_gw = mqtt.Client(INSTANCE_ID)
+telemetry = None
+if args.buffer_file:
+	try:
+		buffer = DiskRingBuffer(args.buffer_file, args.buffer_size * 1024 * 1024, BUFFER_OVERFLOW)
+	except BufferInUseError as e: 		#two gateways writing one ring would corrupt it, this one publishes without a buffer
+		slog.warning('buffer_in_use', path=args.buffer_file, error=str(e), hint="give every instance its own --buffer-file")
+	else:
+		telemetry = StoreAndForward(client_gw, buffer, rate=REPLAY_RATE, batch_size=REPLAY_BATCH)
+		telemetry.start()
+		metrics.gauge('buffer_records', lambda: len(telemetry.buffer))
+		metrics.gauge('buffer_bytes', telemetry.buffer.used)
+		metrics.counter('buffer_dropped_total', lambda: telemetry.buffer.dropped)
+		metrics.counter('buffer_replayed_total', lambda: telemetry.replayed)
+if args.shard:
+	client_gw.will_set(MEMBERS_TOPIC + '/' + INSTANCE_ID, None, qos=1, retain=True) 	#leaves the ring if the gateway dies
+for topic, (handler, qos) in topic_handlers.items():
+	client_gw.message_callback_add(topic, instrumented(topic, handler))
+client_gw.on_connect = gateway_on_connect
+client_gw.on_disconnect = req_response_on_disconnect
+client_gw.on_publish = data_req_on_publish
+slog.event('connecting', broker=broker_address, port=args.broker_port)
+client_gw.connect_async(broker_address, args.broker_port) 	#connects in the network loop, retrying until the broker is reachable
+client_gw.loop_start()
+
+poller = ModbusPoller(poll_points, poll_read_block, poll_publish, max_gap=POLL_MAX_GAP)
+poller.start()
 
 
 time.sleep(100000) #time delay to keep this client online, running and waiting for requests. Can be manually shut down.
 
-#stop loops and disconnect all clients 
-client_reg.loop_stop()
-client_slave.loop_stop()
-client_diu.loop_stop()
-client_data.loop_stop()
-client_data_req.loop_stop()
-client_reg.disconnect()
-client_slave.disconnect()
-client_diu.disconnect()
-client_data.disconnect()
-client_data_req.disconnect()
+#stop the loop and disconnect
+poller.stop()
+if args.shard:
+	client_gw.publish(MEMBERS_TOPIC + '/' + INSTANCE_ID, None, qos=1, retain=True).wait_for_publish()
+client_gw.loop_stop()
+client_gw.disconnect()
+if telemetry is not None:
+	telemetry.stop()
+dispatchers.stop()
+modbus_pool.close_all()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+'''
+MODBUS endpoints of modbus-mqtt_client.py.
+
+Every device names the endpoint its slave is reached through, so one gateway can serve devices behind several MODBUS
+TCP servers and serial lines at once :
+
+    tcp://192.168.1.20:502                          MODBUS TCP server with standard MBAP framing, as served by modbus_server.py
+    tcp://192.168.1.20:502?inflight=32              the same over a slow WAN link, with up to 32 requests outstanding
+    tcp://192.168.1.20:502?framer=rtu               MODBUS TCP server using RTU framing over TCP
+    rtu:///dev/ttyUSB0?baudrate=19200&parity=E      serial RTU line, opened through pyserial
+
+With MBAP framing (framer=socket, the default) every request carries a transaction id, so up to `inflight` (8) requests
+are pipelined on one connection by modbus_pipeline.py and the responses matched to them by id. inflight=1 sends one
+request at a time, as RTU framing over TCP always does.
+
+Serial options are baudrate (9600), parity (N, E or O), stopbits (1) and bytesize (8). An endpoint is stored in the
+device table as its canonical text, with the options sorted, so two spellings of one endpoint share its connections.
+'''
+
+from collections import namedtuple
+from functools import lru_cache
+from urllib.parse import urlsplit, parse_qsl
+
+from pymodbus.client.sync import ModbusTcpClient, ModbusSerialClient
+from pymodbus.framer.rtu_framer import ModbusRtuFramer
+from pymodbus.framer.socket_framer import ModbusSocketFramer
+
+from modbus_pipeline import PipelinedTcpClient
+
+FRAMERS = {'rtu': ModbusRtuFramer, 'socket': ModbusSocketFramer}
+DEFAULT_TCP_FRAMER = 'socket'
+DEFAULT_INFLIGHT = 8 			#requests outstanding per connection with socket framing
+SERIAL_DEFAULTS = {'baudrate': 9600, 'parity': 'N', 'stopbits': 1, 'bytesize': 8}
+
+#------------------------------------------------------------------------------------------------------------------------#
+# kind    - 'tcp' or 'rtu'.
+# address - host for tcp, device path for rtu.
+# port    - TCP port, None for rtu.
+# options - tuple of (name, value) : the framer (and requests in flight with socket framing) for tcp, the line settings for rtu.
+#------------------------------------------------------------------------------------------------------------------------#
+Endpoint = namedtuple('Endpoint', ['kind', 'address', 'port', 'options'])
+
+
+#------------------------------------------------------------------------------------------------------------------------#
+# Parses the text of an endpoint into an Endpoint. Raises ValueError if it is not a valid tcp:// or rtu:// endpoint.
+# Parsed endpoints are cached, as every request looks up the endpoint of its device.
+#------------------------------------------------------------------------------------------------------------------------#
+@lru_cache(maxsize=256)
+def parse_endpoint(text):
+	try:
+		url = urlsplit(text)
+		options = dict(parse_qsl(url.query))
+		if url.scheme == 'tcp':
+			framer = options.pop('framer', DEFAULT_TCP_FRAMER)
+			inflight = int(options.pop('inflight', DEFAULT_INFLIGHT if framer == 'socket' else 1))
+			if not url.hostname or framer not in FRAMERS or options or inflight < 1 or (framer == 'rtu' and inflight > 1):
+				raise ValueError 		#RTU frames carry no transaction id to match pipelined responses with
+			if framer == 'rtu':
+				return Endpoint('tcp', url.hostname, url.port or 502, (('framer', framer),))
+			return Endpoint('tcp', url.hostname, url.port or 502, (('framer', framer), ('inflight', inflight)))
+		if url.scheme == 'rtu':
+			settings = dict(SERIAL_DEFAULTS)
+			for name, value in options.items():
+				if name not in SERIAL_DEFAULTS:
+					raise ValueError
+				settings[name] = value.upper() if name == 'parity' else int(value)
+			if not url.path or settings['parity'] not in ('N', 'E', 'O'):
+				raise ValueError
+			return Endpoint('rtu', url.path, None, tuple(sorted(settings.items())))
+	except (ValueError, TypeError):
+		pass
+	raise ValueError("Invalid endpoint " + str(text))
+
+
+#returns the canonical text of an endpoint, given as text or Endpoint.
+def endpoint_text(endpoint):
+	if not isinstance(endpoint, Endpoint):
+		endpoint = parse_endpoint(endpoint)
+	options = '&'.join('%s=%s' % option for option in endpoint.options)
+	if endpoint.kind == 'tcp':
+		return 'tcp://%s:%d?%s' % (endpoint.address, endpoint.port, options)
+	return 'rtu://%s?%s' % (endpoint.address, options)
+
+
+#a serial line carries one request at a time, a TCP server can take several.
+def is_serial(endpoint):
+	return parse_endpoint(endpoint).kind == 'rtu'
+
+
+#number of requests endpoint takes on one connection before answering the first, 1 unless it pipelines them.
+def max_inflight(endpoint):
+	if not isinstance(endpoint, Endpoint):
+		endpoint = parse_endpoint(endpoint)
+	return dict(endpoint.options).get('inflight', 1) if endpoint.kind == 'tcp' else 1
+
+
+#creates an unconnected client for endpoint, a PipelinedTcpClient if it takes several requests in flight.
+def create_client(endpoint, timeout=3):
+	if max_inflight(endpoint) > 1:
+		return PipelinedTcpClient(endpoint.address, endpoint.port, max_inflight(endpoint), timeout)
+	if endpoint.kind == 'tcp':
+		return ModbusTcpClient(host=endpoint.address, port=endpoint.port, framer=FRAMERS[dict(endpoint.options)['framer']], timeout=timeout)
+	return ModbusSerialClient(method='rtu', port=endpoint.address, timeout=timeout, **dict(endpoint.options))
@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+'''
+Pipelined MODBUS TCP client with standard MBAP framing, used by modbus-mqtt_client.py for tcp://...?framer=socket
+endpoints.
+
+The pymodbus sync clients send one request and wait for its response before the next one can go out, so over a link
+with a 50 ms round trip a connection carries at most 20 requests per second, whatever the link could take. MODBUS TCP
+gives every request a transaction id which the server copies into its response. PipelinedTcpClient sends the requests
+of many threads over one connection without waiting, up to max_inflight of them outstanding, and a reader thread hands
+each response to the request with the same transaction id, whatever order they come back in.
+
+It has the request methods of the pymodbus clients (read_holding_registers, write_registers, ...), each blocking the
+calling thread until its own response arrives, so it is used exactly like a ModbusTcpClient shared by several threads :
+
+    mclient = PipelinedTcpClient('10.0.0.7', 502, max_inflight=8)
+    mclient.connect()
+    rr = mclient.read_holding_registers(0, 10, unit=1) 		#from any number of threads at once
+'''
+
+import socket
+import struct
+import threading
+import time
+
+from pymodbus.client.common import ModbusClientMixin
+from pymodbus.exceptions import ConnectionException, ModbusIOException
+from pymodbus.factory import ClientDecoder
+
+import logging
+log = logging.getLogger(__name__)
+
+_MBAP = struct.Struct('>HHHB') 			#transaction id, protocol id (0), length of unit id + PDU, unit id
+SILENT_UNITS = 2 						#units whose requests timed out with nothing received at all, after which the connection is closed
+KEEPALIVE = (10, 5, 3) 					#seconds idle before the first TCP keepalive probe, seconds between probes, probes lost to drop
+
+
+class PipelinedTcpClient(ModbusClientMixin):
+
+	#-----------------------------------------------------------------------------------------------------------------#
+	# host, port   - MODBUS TCP server.
+	# max_inflight - number of requests sent and not answered yet. Further requests wait for a response to come in.
+	# timeout      - seconds to connect, and to wait for the response to a request once it is sent.
+	# A connection left half open (e.g. by a NAT or a WAN link dropping it) stays open while nothing comes back. It is closed
+	# once TCP keepalive notices, or once requests to SILENT_UNITS units timed out without anything received from any unit
+	# meanwhile, so the pool opens a new one. A single unit which does not answer does not close the connection.
+	#-----------------------------------------------------------------------------------------------------------------#
+	def __init__(self, host, port=502, max_inflight=8, timeout=3):
+		ModbusClientMixin.__init__(self)
+		self.host = host
+		self.port = port
+		self.max_inflight = max_inflight
+		self.timeout = timeout
+		self._decoder = ClientDecoder()
+		self._slots = threading.BoundedSemaphore(max_inflight)
+		self._lock = threading.Lock() 		#guards the transaction ids and _pending
+		self._send_lock = threading.Lock() 	#keeps the frames of concurrent requests apart on the socket
+		self._pending = {} 					#transaction id -> [event, response or exception]
+		self._next_tid = 0
+		self._received = 0 					#monotonic time data last came in
+		self._silent = set() 				#units whose requests timed out with nothing received since they were sent
+		self._socket = None
+		self._reader = None
+
+	def __str__(self):
+		return "PipelinedTcpClient(%s:%s)" % (self.host, self.port)
+
+	def connect(self):
+		if self.is_socket_open():
+			return True
+		self.close()
+		try:
+			sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+		except OSError as e:
+			log.debug("Connection to %s:%s failed : %s", self.host, self.port, e)
+			return False
+		sock.settimeout(None) 		#the reader waits for responses for as long as the connection is open
+		sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+		for option, value in zip(('TCP_KEEPIDLE', 'TCP_KEEPINTVL', 'TCP_KEEPCNT'), KEEPALIVE):
+			if hasattr(socket, option): 		#not on every platform
+				sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
+		self._received = time.monotonic()
+		self._silent = set()
+		self._socket = sock
+		self._reader = threading.Thread(target=self._read, args=(sock,), name="PipelinedTcpClient")
+		self._reader.daemon = True
+		self._reader.start()
+		return True
+
+	def is_socket_open(self):
+		return self._socket is not None and self._reader is not None and self._reader.is_alive()
+
+	def close(self):
+		with self._lock:
+			sock, self._socket = self._socket, None
+		if sock is not None:
+			try:
+				sock.shutdown(socket.SHUT_RDWR) 	#wakes the reader, which fails the requests still waiting
+			except OSError:
+				pass
+			sock.close()
+
+	#number of requests sent and not answered yet.
+	def inflight(self):
+		return len(self._pending)
+
+	#-----------------------------------------------------------------------------------------------------------------#
+	# Sends request and returns its response once it arrives. Can be called from any number of threads at once.
+	# Raises ConnectionException if the connection is closed or lost, ModbusIOException if no response came in time.
+	#-----------------------------------------------------------------------------------------------------------------#
+	def execute(self, request):
+		pdu = struct.pack('>B', request.function_code) + request.encode()
+		if not self._slots.acquire(timeout=self.timeout):
+			raise ModbusIOException("%d requests in flight to %s:%s" % (self.max_inflight, self.host, self.port))
+		try:
+			waiter = [threading.Event(), None]
+			with self._lock:
+				sock = self._socket
+				if sock is None:
+					raise ConnectionException("Not connected to %s:%s" % (self.host, self.port))
+				tid = self._transaction_id()
+				request.transaction_id = tid
+				self._pending[tid] = waiter
+			sent = time.monotonic()
+			try:
+				with self._send_lock:
+					sock.sendall(_MBAP.pack(tid, 0, len(pdu) + 1, request.unit_id) + pdu)
+			except OSError as e:
+				with self._lock:
+					self._pending.pop(tid, None)
+				raise ConnectionException("Sending to %s:%s failed : %s" % (self.host, self.port, e))
+			if not waiter[0].wait(self.timeout):
+				with self._lock:
+					self._pending.pop(tid, None) 		#a late response is dropped by the reader
+					if self._received < sent: 			#nothing at all came in while it was outstanding
+						self._silent.add(request.unit_id)
+					dead = len(self._silent) >= SILENT_UNITS and self._socket is sock
+				if dead:
+					log.warning("Nothing received from %s:%s for units %s, closing the connection", self.host, self.port, sorted(self._silent))
+					self.close()
+				raise ModbusIOException("No response to transaction %d from %s:%s" % (tid, self.host, self.port))
+			if isinstance(waiter[1], Exception):
+				raise waiter[1]
+			return waiter[1]
+		finally:
+			self._slots.release()
+
+	#next transaction id, skipping the ones still waiting for a response. Must be called with the lock held.
+	def _transaction_id(self):
+		while True:
+			self._next_tid = self._next_tid % 0xFFFF + 1
+			if self._next_tid not in self._pending:
+				return self._next_tid
+
+	#reads responses until the connection closes and wakes the request each one answers.
+	def _read(self, sock):
+		buffer = b''
+		error = None
+		try:
+			while True:
+				data = sock.recv(4096)
+				if not data:
+					break
+				buffer += data
+				with self._lock:
+					self._received = time.monotonic()
+					self._silent.clear()
+				while len(buffer) >= _MBAP.size:
+					tid, protocol, length, unit = _MBAP.unpack_from(buffer)
+					if protocol != 0 or length < 2:
+						raise ConnectionException("Invalid MBAP header from %s:%s" % (self.host, self.port))
+					if len(buffer) < 6 + length:
+						break
+					pdu, buffer = buffer[_MBAP.size:6 + length], buffer[6 + length:]
+					self._answer(tid, unit, pdu)
+		except (OSError, ConnectionException) as e:
+			error = e
+		with self._lock:
+			pending = {}
+			if self._socket in (sock, None): 	#not reconnected meanwhile, the requests waiting were sent on sock
+				pending, self._pending = self._pending, {}
+				self._socket = None
+		sock.close()
+		for waiter in pending.values():
+			waiter[1] = ConnectionException("Connection to %s:%s lost%s" % (self.host, self.port, " : %s" % error if error else ""))
+			waiter[0].set()
+
+	def _answer(self, tid, unit, pdu):
+		response = self._decoder.decode(pdu)
+		with self._lock:
+			waiter = self._pending.pop(tid, None)
+		if waiter is None:
+			log.debug("Dropped response to transaction %d, it timed out", tid)
+			return
+		if response is None:
+			waiter[1] = ModbusIOException("Undecodable response to transaction %d" % tid)
+		else:
+			response.transaction_id = tid
+			response.unit_id = unit
+			waiter[1] = response
+		waiter[0].set()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+'''
+Scheduled polling for modbus-mqtt_client.py.
+
+Every configured device is read on its own poll interval. Devices that fall due together are grouped per slave unit
+and registers which are close to each other are merged into one multi-register read, so a slave with hundreds of
+points costs a handful of requests per cycle instead of one request per register. The values are then handed to a
+publish callback per block, which decodes all the values of the block at once.
+
+Block reads are only started by the poller, which publishes each one as soon as it completes and never waits for one
+in particular, so a slow serial line or an unreachable PLC does not hold up the polling of other endpoints. A block
+still in flight when it falls due again is not read twice.
+'''
+
+import threading
+import time
+from concurrent.futures import wait, FIRST_COMPLETED
+
+import logging
+log = logging.getLogger(__name__)
+
+MAX_READ_REGISTERS = 125 		#largest read_holding_registers request allowed by the MODBUS protocol
+
+
+#------------------------------------------------------------------------------------------------------------------------#
+# Plans the block reads for a set of points.
+# points is a list of (device, unit, register, number of registers). Points of the same unit are merged into one read as
+# long as the hole between them is at most max_gap registers and the block does not exceed max_count registers.
+# Returns a list of (unit, start, count, [(device, offset into block), ...]).
+#------------------------------------------------------------------------------------------------------------------------#
+def plan_block_reads(points, max_gap=8, max_count=MAX_READ_REGISTERS):
+	by_unit = {}
+	for device, unit, reg, count in points:
+		by_unit.setdefault(unit, []).append((reg, count, device))
+	blocks = []
+	for unit in sorted(by_unit):
+		start = None
+		for reg, count, device in sorted(by_unit[unit]):
+			if start is not None and reg - end <= max_gap and reg + count - start <= max_count:
+				end = max(end, reg + count)
+				members.append((device, reg - start))
+				continue
+			if start is not None:
+				blocks.append((unit, start, end - start, members))
+			start, end, members = reg, reg + count, [(device, 0)]
+		if start is not None:
+			blocks.append((unit, start, end - start, members))
+	return blocks
+
+
+class ModbusPoller(threading.Thread):
+
+	#-----------------------------------------------------------------------------------------------------------------#
+	# get_points - called every cycle, returns a list of (device, unit, register, number of registers, interval in seconds).
+	#              Devices with an interval of 0 or less are not polled. Calling it every cycle picks up config changes.
+	# read_block - read_block(unit, start, count) starts a block read and returns a concurrent.futures.Future of the list
+	#              of register values, failing if the read failed.
+	# publish    - publish(registers, [(device, offset into registers), ...]) is called with every block read, from the
+	#              poller thread.
+	# max_gap    - largest hole of unused registers allowed inside one merged read.
+	#-----------------------------------------------------------------------------------------------------------------#
+	def __init__(self, get_points, read_block, publish, max_gap=8, tick=0.1):
+		threading.Thread.__init__(self, name="ModbusPoller")
+		self.daemon = True
+		self.get_points = get_points
+		self.read_block = read_block
+		self.publish = publish
+		self.max_gap = max_gap
+		self.tick = tick
+		self._next_due = {} 			#device -> monotonic time of its next poll
+		self._inflight = {} 			#(unit, start, count) -> (future, members) of the block reads not done yet
+		self._stop_event = threading.Event()
+
+	def stop(self):
+		self._stop_event.set()
+
+	def run(self):
+		while not self._stop_event.is_set():
+			try:
+				self.poll_once(time.monotonic())
+			except Exception:
+				log.exception("Polling cycle failed")
+			if self._inflight: 			#wakes up as soon as a read completes, to publish it
+				wait([future for future, members in self._inflight.values()], self.tick, FIRST_COMPLETED)
+			else:
+				self._stop_event.wait(self.tick)
+			self.publish_done()
+
+	#starts the reads of every device that is due at time now and schedules its next poll.
+	def poll_once(self, now):
+		due = []
+		seen = set()
+		for device, unit, reg, count, interval in self.get_points():
+			if interval <= 0:
+				continue
+			seen.add(device)
+			next_due = self._next_due.setdefault(device, now) 	#new devices are polled straight away
+			if next_due <= now:
+				due.append((device, unit, reg, count))
+				#stay on the interval grid unless we fell more than a whole interval behind
+				self._next_due[device] = next_due + interval if next_due + interval > now else now + interval
+		for device in list(self._next_due):
+			if device not in seen:
+				del self._next_due[device]
+		for unit, start, count, members in plan_block_reads(due, self.max_gap):
+			if (unit, start, count) in self._inflight:
+				continue 				#the last read of this block has not come back yet
+			try:
+				self._inflight[(unit, start, count)] = (self.read_block(unit, start, count), members)
+			except Exception as e:
+				log.warning("Poll of unit %s registers %s-%s failed: %s", unit, start, start + count - 1, e)
+
+	#publishes the block reads which completed.
+	def publish_done(self):
+		for (unit, start, count), (future, members) in list(self._inflight.items()):
+			if not future.done():
+				continue
+			del self._inflight[(unit, start, count)]
+			if future.exception() is not None:
+				log.warning("Poll of unit %s registers %s-%s failed: %s", unit, start, start + count - 1, future.exception())
+				continue
+			try:
+				self.publish(future.result(), members)
+			except Exception:
+				log.exception("Publishing poll of unit %s failed", unit)
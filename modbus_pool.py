@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+'''
+Connection pool for the pymodbus TCP clients used by modbus-mqtt_client.py.
+
+Opening a new ModbusTcpClient for every MQTT message costs a full TCP handshake per request and, when close() is
+forgotten, leaks a socket each time. This pool keeps long-lived connections keyed by their endpoint of
+modbus_endpoints.py (a TCP server or a serial line), checks that a connection is still alive before handing it out,
+reconnects with exponential backoff when a server goes away and keeps at most max_idle idle connections per endpoint.
+
+An endpoint which pipelines requests (max_inflight above 1) has a single connection instead, handed to every thread at
+once : its PipelinedTcpClient keeps the requests of all of them in flight together.
+'''
+
+import socket
+import threading
+import time
+from contextlib import contextmanager
+
+from pymodbus.exceptions import ConnectionException
+
+from modbus_endpoints import create_client, max_inflight
+
+import logging
+log = logging.getLogger(__name__)
+
+
+#-----------------------------------------------------------------------------------------------------------------------#
+# Health check of an idle client. pymodbus only checks that it has a socket, so a connection the server closed (e.g. when
+# it restarted) would fail the next request. Nothing may be waiting to be read on an idle TCP connection : a peek which
+# reads the end of the stream or a stray byte means it is dead. Serial lines are taken as they are.
+#-----------------------------------------------------------------------------------------------------------------------#
+def _alive(mclient):
+	if not mclient.is_socket_open():
+		return False
+	sock = getattr(mclient, 'socket', None)
+	if not isinstance(sock, socket.socket):
+		return True
+	timeout = sock.gettimeout()
+	try:
+		sock.setblocking(False)
+		sock.recv(1, socket.MSG_PEEK)
+		return False
+	except BlockingIOError:
+		return True 				#nothing to read, the connection is still up
+	except OSError:
+		return False
+	finally:
+		sock.settimeout(timeout)
+
+
+class ModbusConnectionPool(object):
+
+	#-----------------------------------------------------------------------------------------------------------------#
+	# max_idle        - number of idle connections kept open per endpoint. Extra ones are closed on release.
+	# backoff_initial - delay in seconds before retrying a server that refused a connection. Doubles on every failure.
+	# backoff_max     - upper bound for the retry delay.
+	# timeout         - socket timeout passed to every client.
+	#-----------------------------------------------------------------------------------------------------------------#
+	def __init__(self, max_idle=4, backoff_initial=0.5, backoff_max=30.0, timeout=3):
+		self.max_idle = max_idle
+		self.backoff_initial = backoff_initial
+		self.backoff_max = backoff_max
+		self.timeout = timeout
+		self._lock = threading.Lock()
+		self._idle = {} 			#key -> list of idle connected clients
+		self._shared = {} 			#key -> the connected client of a pipelined endpoint, used by every thread
+		self._connecting = {} 		#key -> lock held while the shared client of key (re)connects
+		self._backoff = {} 			#key -> (next attempt time, current delay)
+		self.connects = 0 			#connections opened, the first one per key included
+		self.connect_failures = 0 	#connection attempts which failed
+
+	#-----------------------------------------------------------------------------------------------------------------#
+	# Returns a connected client for an Endpoint of modbus_endpoints.py, either an idle one that is still open or a
+	# freshly connected one. A pipelined endpoint returns its shared client.
+	# Raises ConnectionException if the server cannot be reached or is still inside its backoff window.
+	#-----------------------------------------------------------------------------------------------------------------#
+	def acquire_endpoint(self, endpoint):
+		name = endpoint.address if endpoint.port is None else "%s:%s" % (endpoint.address, endpoint.port)
+		if max_inflight(endpoint) > 1:
+			return self._acquire_shared(endpoint, name, lambda: create_client(endpoint, self.timeout))
+		return self._acquire(endpoint, name, lambda: create_client(endpoint, self.timeout))
+
+	def _acquire(self, key, name, create):
+		with self._lock:
+			idle = self._idle.get(key, [])
+			while idle:
+				mclient = idle.pop()
+				if _alive(mclient): 			#health check, dead connections are dropped here
+					return mclient
+				mclient.close()
+		return self._connect(key, name, create)
+
+	def _acquire_shared(self, key, name, create):
+		mclient = self._shared.get(key)
+		if mclient is not None and mclient.is_socket_open():
+			return mclient
+		with self._lock:
+			connecting = self._connecting.setdefault(key, threading.Lock())
+		with connecting: 				#one thread reconnects, the others wait for its client
+			mclient = self._shared.get(key)
+			if mclient is not None and mclient.is_socket_open():
+				return mclient
+			if mclient is not None:
+				mclient.close()
+			mclient = self._connect(key, name, create)
+			self._shared[key] = mclient
+			return mclient
+
+	#creates and connects a new client for key, unless the server is inside its backoff window.
+	def _connect(self, key, name, create):
+		with self._lock:
+			retry = self._backoff.get(key)
+		if retry is not None and time.monotonic() < retry[0]:
+			raise ConnectionException("%s in reconnect backoff" % name)
+		mclient = create()
+		if not mclient.connect():
+			mclient.close()
+			self._connect_failed(key, name)
+			raise ConnectionException("Failed to connect to %s" % name)
+		mclient.pool_key = key 		#the key release() returns the client under
+		with self._lock:
+			self._backoff.pop(key, None)
+			self.connects += 1
+		return mclient
+
+	#-----------------------------------------------------------------------------------------------------------------#
+	# Gives a client back to the pool. Broken clients and clients above the idle cap are closed instead. A shared client
+	# stays open for the other threads unless its connection is gone, a request timing out does not break it.
+	#-----------------------------------------------------------------------------------------------------------------#
+	def release(self, mclient, broken=False):
+		key = mclient.pool_key
+		if self._shared.get(key) is mclient:
+			if not mclient.is_socket_open():
+				mclient.close()
+			return
+		if not broken and mclient.is_socket_open():
+			with self._lock:
+				idle = self._idle.setdefault(key, [])
+				if len(idle) < self.max_idle:
+					idle.append(mclient)
+					return
+		mclient.close()
+
+	#-----------------------------------------------------------------------------------------------------------------#
+	# Context manager around acquire_endpoint()/release(). A connection which raised an error is not reused.
+	#
+	#     with pool.endpoint_connection(parse_endpoint("tcp://localhost:502")) as mclient:
+	#         mclient.read_holding_registers(reg, 1, unit=UNIT)
+	#-----------------------------------------------------------------------------------------------------------------#
+	@contextmanager
+	def endpoint_connection(self, endpoint):
+		with self._using(self.acquire_endpoint(endpoint)) as mclient:
+			yield mclient
+
+	@contextmanager
+	def _using(self, mclient):
+		try:
+			yield mclient
+		except Exception:
+			self.release(mclient, broken=True)
+			raise
+		self.release(mclient)
+
+	def _connect_failed(self, key, name):
+		with self._lock:
+			self.connect_failures += 1
+			retry = self._backoff.get(key)
+			delay = self.backoff_initial if retry is None else min(retry[1] * 2, self.backoff_max)
+			self._backoff[key] = (time.monotonic() + delay, delay)
+		log.warning("Modbus server %s unreachable, retrying in %.1fs", name, delay)
+
+	#closes every idle connection. Called when the gateway shuts down.
+	def close_all(self):
+		with self._lock:
+			idle, self._idle = self._idle, {}
+			shared, self._shared = self._shared, {}
+		for clients in list(idle.values()) + [[mclient] for mclient in shared.values()]:
+			for mclient in clients:
+				mclient.close()
@@ -4,7 +4,22 @@ Pymodbus implementation of Modbus TCP client-server. Read from holding registers
 Server - Local Pymodbus TCP server
 Client - Pymodbus TCP client
 
+Simulator mode (--simulate) serves many unit IDs with large address spaces for load testing the gateway, e.g.::
+
+    python modbus_server.py --simulate --units 200 --size 10000 --port 5020
+
+Every unit gets its own registers stored in compact arrays, the server runs on asyncio so it can hold thousands of
+concurrent connections, and a share of the holding and input registers is changed every --update-interval seconds.
+
+With --datastore DIR the registers are kept in memory mapped files in DIR instead (see compact_datastore.py), so they
+survive a restart, and a gateway on the same host reads them from shared memory with --shared-datastore DIR::
+
+    python modbus_server.py --datastore /var/lib/modbus
 """
+import argparse
+import asyncio
+import os
+import random
 from threading import Timer
 
 from pymodbus.server.sync import StartTcpServer
@@ -16,9 +31,11 @@ from pymodbus.device import ModbusDeviceIdentification
 from pymodbus.datastore import ModbusSequentialDataBlock, ModbusSparseDataBlock
 from pymodbus.datastore import ModbusSlaveContext, ModbusServerContext
 
-from pymodbus.transaction import ModbusRtuFramer, ModbusBinaryFramer
+from pymodbus.transaction import ModbusRtuFramer, ModbusBinaryFramer, ModbusSocketFramer
 from pymodbus.client.sync import ModbusTcpClient as ModbusClient
 
+from compact_datastore import ArrayDataBlock, MappedDataBlock, datastore_path
+
 # --------------------------------------------------------------------------- #
 # configure the service logging
 # --------------------------------------------------------------------------- #
@@ -29,6 +46,73 @@ logging.basicConfig(format=FORMAT)
 log = logging.getLogger()
 log.setLevel(logging.DEBUG)
 
+parser = argparse.ArgumentParser(description="Modbus TCP server")
+parser.add_argument('--host', default="localhost")
+parser.add_argument('--port', type=int, default=502)
+parser.add_argument('--framer', default='socket', choices=['socket', 'rtu'], help="standard MBAP framing, which lets clients pipeline requests, or RTU framing over TCP")
+parser.add_argument('--simulate', action='store_true', help="serve many simulated units on an asyncio server")
+parser.add_argument('--units', type=int, default=100, help="simulator : number of unit IDs, served as 1 to UNITS")
+parser.add_argument('--size', type=int, default=10000, help="simulator : number of registers in every table of a unit")
+parser.add_argument('--update-interval', type=float, default=1.0, help="simulator : seconds between value changes, 0 for static values")
+parser.add_argument('--update-fraction', type=float, default=0.01, help="simulator : share of the registers changed each time")
+parser.add_argument('--datastore', help="directory of memory mapped register files, kept across restarts and shared with a gateway on this host")
+args = parser.parse_args()
+if args.datastore:
+    os.makedirs(args.datastore, exist_ok=True)
+framer = ModbusSocketFramer if args.framer == 'socket' else ModbusRtuFramer
+
+
+# ----------------------------------------------------------------------- #
+# simulator
+# ----------------------------------------------------------------------- #
+def build_block(directory, unit, table, size, value, typecode='H'):
+    """ Datablock of one table of unit, in a file of directory if given, else in an array """
+    if directory:
+        return MappedDataBlock(datastore_path(directory, unit, table), 0, size, value, typecode)
+    return ArrayDataBlock(0, size, value, typecode)
+
+
+def build_simulator_context(units, size, directory=None):
+    """ One slave context per unit ID 1..units, every table holding size registers in an array or a file """
+    slaves = {}
+    for unit in range(1, units + 1):
+        slaves[unit] = ModbusSlaveContext(
+            di=build_block(directory, unit, 'di', size, 0, 'B'),
+            co=build_block(directory, unit, 'co', size, 0, 'B'),
+            hr=build_block(directory, unit, 'hr', size, 17),
+            ir=build_block(directory, unit, 'ir', size, 17))
+    return ModbusServerContext(slaves=slaves, single=False)
+
+
+async def update_values(context, units, size, interval, fraction):
+    """ Random walk of a share of the holding and input registers of every unit, so pollers see changing values """
+    changes = max(1, int(size * fraction))
+    while True:
+        await asyncio.sleep(interval)
+        for unit in range(1, units + 1):
+            for table in ('h', 'i'):       # holding and input registers
+                block = context[unit].store[table]
+                values = block.values
+                for index in random.sample(range(size), changes):
+                    value = (values[index] + random.randint(-5, 5)) & 0xFFFF
+                    if isinstance(block, MappedDataBlock):
+                        block.setValues(block.address + index, [value])     # through the seqlock, gateways may be reading
+                    else:
+                        values[index] = value
+
+
+async def run_simulator(context, identity, address, args):
+    try:
+        from pymodbus.server.async_io import StartTcpServer as StartAsyncTcpServer
+    except ImportError:     # pymodbus < 2.5
+        from pymodbus.server.asyncio import StartTcpServer as StartAsyncTcpServer
+    server = await StartAsyncTcpServer(context, identity=identity, address=address, framer=framer,
+                                       allow_reuse_address=True, defer_start=True)     # restarts while old connections are in TIME_WAIT
+    if args.update_interval > 0:
+        asyncio.ensure_future(update_values(context, args.units, args.size, args.update_interval, args.update_fraction))
+    log.info("Simulating %d units of %d registers on %s:%d", args.units, args.size, address[0], address[1])
+    await server.serve_forever()
+
 # ----------------------------------------------------------------------- #
     # initialize your data store
     # ----------------------------------------------------------------------- #
@@ -83,18 +167,30 @@ log.setLevel(logging.DEBUG)
     #
     #     store = ModbusSlaveContext(..., zero_mode=True)
     # ----------------------------------------------------------------------- #
-store = ModbusSlaveContext(
-    di=ModbusSequentialDataBlock(0, [17]*100),
-    co=ModbusSequentialDataBlock(0, [17]*100),
-    hr=ModbusSequentialDataBlock(0, [17]*100),
-    ir=ModbusSequentialDataBlock(0, [17]*100))
+if args.simulate:
+    log.setLevel(logging.INFO)     # per request debug logging does not keep up with a load test
+    context = build_simulator_context(args.units, args.size, args.datastore)
+elif args.datastore:
+    # one store serves every unit, its files are those of unit 0
+    store = ModbusSlaveContext(
+        di=MappedDataBlock(datastore_path(args.datastore, 0, 'di'), 0, 100, 17),
+        co=MappedDataBlock(datastore_path(args.datastore, 0, 'co'), 0, 100, 17),
+        hr=MappedDataBlock(datastore_path(args.datastore, 0, 'hr'), 0, 100, 17),
+        ir=MappedDataBlock(datastore_path(args.datastore, 0, 'ir'), 0, 100, 17))
+    context = ModbusServerContext(slaves=store, single=True)
+else:
+    store = ModbusSlaveContext(
+        di=ModbusSequentialDataBlock(0, [17]*100),
+        co=ModbusSequentialDataBlock(0, [17]*100),
+        hr=ModbusSequentialDataBlock(0, [17]*100),
+        ir=ModbusSequentialDataBlock(0, [17]*100))
+    context = ModbusServerContext(slaves=store, single=True)
 
 # ----------------------------------------------------------------------- #
     # initialize the server information
     # ----------------------------------------------------------------------- #
     # If you don't set this or any fields, they are defaulted to empty strings.
     # ----------------------------------------------------------------------- #	
-context = ModbusServerContext(slaves=store, single=True)
 identity = ModbusDeviceIdentification()
 identity.VendorName = 'Pymodbus'
 identity.ProductCode = 'PM'
@@ -107,6 +203,9 @@ identity.MajorMinorRevision = '2.2.0'
     # run the server you want
     # ----------------------------------------------------------------------- #
     # Tcp:
-StartTcpServer(context, identity=identity, address=("localhost", 502), framer = ModbusRtuFramer)
+if args.simulate:
+    asyncio.run(run_simulator(context, identity, (args.host, args.port), args))
+else:
+    StartTcpServer(context, identity=identity, address=(args.host, args.port), framer = framer)
 
 
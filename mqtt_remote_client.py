@@ -14,6 +14,12 @@ for each slave can also be configured by the user. Data can be read/written to t
 import paho.mqtt.client as mqtt
 import time
 import json
+import sys
+import os
+import argparse
+import threading
+from concurrent.futures import Future, as_completed
+from mqtt_rpc import GatewayClient
 
 #--------------------------------------------------------------------------------------------------------------------------------#
 # reg_config dict includes some standard devices register configuration which can be changed or new devices can be added.
@@ -25,7 +31,15 @@ reg_config={"energy_meter": '01',"temp_sensor":'05'}
 #------------------------------------------------------------------------------------------------------------#
 slave_config={"energy_meter":'01',"temp_sensor":'02'}
 
+#------------------------------------------------------------------------------------------------------------#
+# poll_config has the poll interval in seconds of each device. Polled values are published to poll/<device>.
+#------------------------------------------------------------------------------------------------------------#
+poll_config={"energy_meter":'10',"temp_sensor":'30'}
+
 read_req_value = 0 #to store response of read_req. 
+config_version = None 	#version of the device table last announced by the gateway on config_version
+version_changed = threading.Condition()
+CONFIG_TIMEOUT = 10 	#seconds to wait for the gateway to apply pushed configs
 
 #method to display a message once the user(client1) has connected to mqtt server. Called when connection is succesful.
 def on_connect(client, userdata, flags, rc):
@@ -40,11 +54,92 @@ def on_publish(client, userdata, mid):
 #method to print the data received from the register after sending a read request.
 def data_req_on_message(client,userdata,message):
 	print("Data received :\n")
-	read_req_value = int(message.payload)
+	read_req_value = message.payload.decode("utf-8") 	#value as text, it may be an integer or a float depending on the data type of the device
 	print("Register value :\n")
 	print(read_req_value)
+
+#method to store the device table version the gateway announces once it applied a config.
+def config_version_on_message(client, userdata, message):
+	global config_version
+	with version_changed:
+		config_version = int(message.payload)
+		version_changed.notify_all()
+
+#----------------------------------------------------------------------------------------------------------------------------------#
+# Publishes the given configs, retained, and waits until the gateway announced a device table compiled from all of them. The
+# broker hands a QoS 2 message to the gateway only once its PUBREL arrives, so a request sent right after the configs could reach
+# the gateway before them. The gateway compiles a new table, and announces its version, for each config it receives.
+#----------------------------------------------------------------------------------------------------------------------------------#
+def push_configs(*configs):
+	with version_changed:
+		since = config_version
+	for topic, config in configs:
+		print("Pushing " + topic)
+		client1.publish(topic,json.dumps(config),qos=2,retain=True)
+	with version_changed:
+		applied = version_changed.wait_for(lambda: config_version is not None and (since is None or config_version >= since + len(configs)), CONFIG_TIMEOUT)
+	if not applied:
+		print("The gateway did not confirm the configs, it may not be running.")
 	
-broker_address="test.mosquitto.org" #Using online broker
+#-----------------------------------------------------------------------------------------------------------------------------------#
+# Batch mode. Runs every operation of a file and prints each result as soon as it arrives. One operation per line :
+#     read energy_meter
+#     write temp_sensor 25
+# Empty lines and lines starting with # are skipped. The operations of different devices are all in flight together, those of one
+# device run in the order of the file, each one sent once the previous one is answered, so a read after a write sees the value written.
+#-----------------------------------------------------------------------------------------------------------------------------------#
+def run_batch(gateway, path):
+	futures = {}
+	last = {} 			#device -> future of its last operation
+	with open(path) as ops:
+		for line in ops:
+			op = line.split()
+			if not op or op[0].startswith('#'):
+				continue
+			if op[0] == 'read' and len(op) == 2:
+				send = lambda device=op[1]: gateway.read(device)
+			elif op[0] == 'write' and len(op) == 3:
+				send = lambda device=op[1], value=float(op[2]): gateway.write(device, value)
+			else:
+				print("Invalid operation :", line.strip())
+				continue
+			last[op[1]] = send_after(last.get(op[1]), send)
+			futures[last[op[1]]] = line.strip()
+	failed = 0
+	for future in as_completed(futures):
+		try:
+			print(futures[future], "->", future.result())
+		except Exception as e:
+			failed += 1
+			print(futures[future], "-> failed :", e)
+	return failed
+
+#returns the future of send(), called once previous is done, whatever its outcome, or at once if there is no previous.
+def send_after(previous, send):
+	if previous is None:
+		return send()
+	result = Future()
+	def answered(done):
+		if done.exception() is not None:
+			result.set_exception(done.exception())
+		else:
+			result.set_result(done.result())
+	def previous_done(done):
+		try:
+			send().add_done_callback(answered)
+		except Exception as e:
+			result.set_exception(e)
+	previous.add_done_callback(previous_done)
+	return result
+
+parser = argparse.ArgumentParser(description="Remote MQTT client for modbus-mqtt_client.py")
+parser.add_argument('--batch', metavar='FILE', help="run the operations in FILE and exit instead of prompting")
+parser.add_argument('--broker', default="test.mosquitto.org", help="address of the MQTT broker")
+parser.add_argument('--broker-port', type=int, default=1883)
+parser.add_argument('--client-id', default="P1-%d" % os.getpid(), help="MQTT client id, unique per remote client")
+args = parser.parse_args()
+
+broker_address=args.broker #Using online broker test.mosquitto.org unless another broker is given
 
 #-------------------------------------------------------------------------------------------------------------------------------------------------------#
 # Creating instance client1. This client is the end user which will send requests to read/write data from modbus tcp slaves and can be a remote client. 
@@ -52,28 +147,35 @@ broker_address="test.mosquitto.org" #Using online broker
 # Client2 is both an MQTT client and MODBUS client. It sends the received request to the MODBUS server to cread/write data from the slaves. 
 #--------------------------------------------------------------------------------------------------------------------------------------------------------#
 print("creating new instance")
-client1 = mqtt.Client("P1")
+client1 = mqtt.Client(args.client_id)
 client1.on_publish = on_publish
 client1.on_message = data_req_on_message
 print("connecting to broker")
-client1.connect(broker_address) #connect to broker
+client1.connect(broker_address, args.broker_port) #connect to broker
+client1.message_callback_add('config_version', config_version_on_message)
+client1.subscribe('config_version',qos=1) 	#the retained version tells which version the pushed configs must go past
 client1.loop_start() 			#start the loop
+with version_changed:
+	version_changed.wait_for(lambda: config_version is not None, 2) 	#no version if no gateway ever ran
 
-print("Pushing reg_config")
-client1.publish('reg_config',json.dumps(reg_config),qos=2) #Pushing initial reg_config
-time.sleep(2) 											   #delay to wait till reg_config is pushed before prompting for data input
-
-print("Pushing slave_config")
-client1.publish('slave_config',json.dumps(slave_config),qos=2) 	#Pushing initial slave_config
-time.sleep(2) 													#delay to wait till slave_config is pushed before prompting for data input
+#--------------------------------------------------------------------------------------------------------------------------------------------#
+# The configs are published retained, so a gateway which (re)starts later gets them from the broker without this client running again.
+# Requests are only sent once the gateway announced it applied them.
+#--------------------------------------------------------------------------------------------------------------------------------------------#
+push_configs(('reg_config', reg_config), ('slave_config', slave_config), ('poll_config', poll_config)) 	#Pushing initial configs
 
 print("Subscribing to data request")
 client1.subscribe('data_req',qos=0)  #Subscribing to data request topic where the requested data from register is published by client2. 
-time.sleep(2)
+gateway = GatewayClient(client1, args.client_id) 	#reads and writes go through the cmd topic and their replies come back on reply/<client id>/<request id>
+
+if args.batch:
+	failed = run_batch(gateway, args.batch)
+	client1.loop_stop()
+	sys.exit(1 if failed else 0)
 
 cont = 'Y' #loop control variable
 while cont == 'Y':
-	choice = input('1)data_write\n2)data_read\n3)reg_config\n4)slave_config\n')
+	choice = input('1)data_write\n2)data_read\n3)reg_config\n4)slave_config\n5)poll_config\n')
 	if choice == '3':
 		print(reg_config)
 		choice = input('1)Change existing\n2)Add new\n3)Exit\n')
@@ -92,9 +194,7 @@ while cont == 'Y':
 			continue
 		print("new reg_config:\n")
 		print(reg_config)
-		print("Pushing reg_config\n")
-		client1.publish('reg_config',json.dumps(reg_config),qos=2)
-		time.sleep(3)
+		push_configs(('reg_config', reg_config))
 	elif choice == '4':
 		print(slave_config)
 		choice = input('1)Change existing\n2)Add new\n3)Exit\n')
@@ -117,23 +217,29 @@ while cont == 'Y':
 		print(slave_config)
 		print("new reg_config:\n")
 		print(reg_config)
-		print("Pushing slave_config and reg_config\n")
-		client1.publish('slave_config',json.dumps(slave_config),qos=2)
-		time.sleep(2)
-		client1.publish('reg_config',json.dumps(reg_config),qos=2)
-		time.sleep(2)
+		push_configs(('slave_config', slave_config), ('reg_config', reg_config))
+	elif choice == '5':
+		print(poll_config)
+		device = input("Enter device\n")
+		value = input("Enter poll interval in seconds (0 to stop polling)\n")
+		poll_config[locals()['device']] = value
+		print("new poll_config:\n")
+		print(poll_config)
+		push_configs(('poll_config', poll_config))
 	elif choice == '1':
 		device = input("Select device to which data is to be pushed:\n")
-		value = int(input("Enter value(in decimal) to put in register :\n"))
+		value = float(input("Enter value(in decimal) to put in register :\n"))
 		try:
 			UNIT = int(slave_config[locals()['device']])  #Checking if entered device has been added as a slave.
 		except:
 			print("Device does not exist in database. Please add the device to slave_config or select existing device.")
 			continue 
 		print("Pushing value to device\n",device)
-		client1.publish('device_in_use',device,qos=0) #publish the device currently in use. the register number of tht device is taken from reg_config and value is written.
-		client1.publish('data',value,qos=0)	#publish value to be put in register
-		time.sleep(2)
+		try:
+			gateway.write(device, value).result() 	#waits for the gateway to confirm the write
+			print("Value written.")
+		except Exception as e:
+			print("Write failed :", e)
 	elif choice == '2':
 		device = input("Select device from which data is to be read:\n")
 		try:
@@ -141,8 +247,11 @@ while cont == 'Y':
 		except:
 			print("Device does not exist in database. Please add device to slave_config or select existing device.")
 			continue
-		client1.publish('read_req',device,qos=0)
-		time.sleep(5)
+		try:
+			print("Register value :\n")
+			print(gateway.read(device).result()) 	#waits for the value read by the gateway
+		except Exception as e:
+			print("Read failed :", e)
 	else:
 		print("Invalid choice")
 	cont = input("Continue? [Y/N]\n")
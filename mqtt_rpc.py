@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+'''
+Correlated request/response client for the cmd topic of modbus-mqtt_client.py.
+
+Every request is one self-contained JSON command published to cmd :
+
+    {"id": "7", "op": "read", "device": "energy_meter", "reply_to": "reply/P1/7"}
+    {"id": "8", "op": "write", "device": "energy_meter", "value": 42, "reply_to": "reply/P1/8"}
+
+The gateway answers on the reply_to topic of that request with the same id. reply_to must be below REPLY_PREFIX,
+so a command cannot make the gateway publish on its own topics :
+
+    {"id": "7", "ok": true, "value": 17}
+    {"id": "8", "ok": true, "value": 42}
+    {"id": "8", "ok": false, "error": "Unknown device energy_meter"}
+
+GatewayClient.read() and GatewayClient.write() return a concurrent.futures.Future immediately, so any number of
+requests can be in flight at the same time. Futures which get no reply within the timeout fail with TimeoutError.
+'''
+
+import itertools
+import json
+import threading
+import time
+from concurrent.futures import Future, TimeoutError
+
+CMD_TOPIC = 'cmd'
+REPLY_PREFIX = 'reply/'
+
+
+#raised through a future when the gateway reports that a request failed.
+class GatewayError(Exception):
+	pass
+
+
+class GatewayClient(object):
+
+	#-----------------------------------------------------------------------------------------------------------------#
+	# client    - a connected paho client with its network loop running. Replies are received through it.
+	# client_id - unique name of this client, replies are published below reply/<client_id>/.
+	# timeout   - seconds to wait for a reply before the future fails with TimeoutError.
+	#-----------------------------------------------------------------------------------------------------------------#
+	def __init__(self, client, client_id, timeout=10.0, qos=1):
+		self.client = client
+		self.reply_prefix = REPLY_PREFIX + client_id + '/'
+		self.timeout = timeout
+		self.qos = qos
+		self._ids = itertools.count(1)
+		self._lock = threading.Lock()
+		self._pending = {} 			#request id -> (future, deadline)
+		client.message_callback_add(self.reply_prefix + '#', self._on_reply)
+		client.subscribe(self.reply_prefix + '#', qos=qos)
+		sweeper = threading.Thread(target=self._expire_pending, name="GatewayClientTimeouts")
+		sweeper.daemon = True
+		sweeper.start()
+
+	#reads the register of device. The future result is the register value.
+	def read(self, device):
+		return self._request({'op': 'read', 'device': device})
+
+	#writes value into the register of device. The future result is the value the device holds once it is written.
+	def write(self, device, value):
+		return self._request({'op': 'write', 'device': device, 'value': value})
+
+	def _request(self, command):
+		future = Future()
+		with self._lock:
+			req_id = str(next(self._ids))
+			self._pending[req_id] = (future, time.monotonic() + self.timeout)
+		command['id'] = req_id
+		command['reply_to'] = self.reply_prefix + req_id
+		self.client.publish(CMD_TOPIC, json.dumps(command), qos=self.qos)
+		return future
+
+	def _on_reply(self, client, userdata, message):
+		try:
+			reply = json.loads(message.payload)
+			req_id = str(reply['id'])
+		except (ValueError, KeyError, TypeError):
+			return
+		with self._lock:
+			entry = self._pending.pop(req_id, None)
+		if entry is None:
+			return 						#reply to a request which has already timed out
+		if reply.get('ok'):
+			entry[0].set_result(reply.get('value'))
+		else:
+			entry[0].set_exception(GatewayError(reply.get('error', 'request failed')))
+
+	#fails the futures of requests whose reply did not arrive in time.
+	def _expire_pending(self):
+		while True:
+			time.sleep(0.5)
+			now = time.monotonic()
+			with self._lock:
+				expired = [req_id for req_id, (future, deadline) in self._pending.items() if deadline < now]
+				entries = [self._pending.pop(req_id) for req_id in expired]
+			for future, deadline in entries:
+				future.set_exception(TimeoutError("No reply from gateway"))
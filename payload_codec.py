@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+'''
+Typed register decoding and batched payload encoding for modbus-mqtt_client.py.
+
+A device has a data type (int16, uint16, int32, uint32, float32, float64), a scale factor and a byte and word order,
+with the same meaning as the byteorder and wordorder of pymodbus' BinaryPayloadDecoder. A 32 bit meter value thus
+spans two registers and a float64 four.
+
+Rather than building a decoder per value, decode_block() decodes every point of a block read in one pass : the
+registers of all points are put in big endian order, packed into one buffer and unpacked with a single precompiled
+struct. The struct of a block layout is compiled once and reused by every later poll of the same layout.
+
+Polled values can be published as :
+    text   - one message per device, the value as text (what read_req has always published)
+    json   - one message per batch, a JSON array of [device, value, timestamp] points
+    binary - one message per batch, struct packed : a little endian uint16 point count, then for every point a uint8
+             name length, the utf-8 name, the value as float64 and the timestamp as float64
+'''
+
+import json
+import struct
+from decimal import Decimal
+from functools import lru_cache
+
+#data type -> (struct format, number of registers)
+TYPE_FORMATS = {
+	'int16': ('h', 1),
+	'uint16': ('H', 1),
+	'int32': ('i', 2),
+	'uint32': ('I', 2),
+	'float32': ('f', 2),
+	'float64': ('d', 4),
+}
+BYTE_ORDERS = ('big', 'little')
+ENCODINGS = ('text', 'json', 'binary')
+
+
+#number of registers a value of dtype takes.
+def register_count(dtype):
+	return TYPE_FORMATS[dtype][1]
+
+
+#---------------------------------------------------------------------------------------------------------------------#
+# Compiles the decoder of one block layout. layout is a tuple of (offset, dtype, byte_order, word_order) per point.
+# Returns (register order, registers to byte swap, struct) : the registers of the block are picked in register order,
+# the ones at the positions of the second list byte swapped and the result packed as big endian and unpacked by struct.
+#---------------------------------------------------------------------------------------------------------------------#
+@lru_cache(maxsize=256)
+def _compile(layout):
+	order = []
+	swapped = []
+	fmt = '>'
+	for offset, dtype, byte_order, word_order in layout:
+		code, count = TYPE_FORMATS[dtype]
+		regs = list(range(offset, offset + count))
+		if word_order == 'little':
+			regs.reverse()
+		if byte_order == 'little':
+			swapped.extend(range(len(order), len(order) + count))
+		order.extend(regs)
+		fmt += code
+	return tuple(order), tuple(swapped), struct.Struct(fmt)
+
+
+#-----------------------------------------------------------------------------------------------------------------------#
+# Decodes the values of many devices from the registers of one block read.
+# points is a list of (offset into registers, Device). Returns the list of values, scaled by the scale of each device.
+#-----------------------------------------------------------------------------------------------------------------------#
+def decode_block(registers, points):
+	layout = tuple((offset, dev.dtype, dev.byte_order, dev.word_order) for offset, dev in points)
+	order, swapped, decoder = _compile(layout)
+	picked = [registers[i] for i in order]
+	for i in swapped:
+		picked[i] = ((picked[i] & 0xFF) << 8) | (picked[i] >> 8)
+	raw = decoder.unpack(struct.pack('>%dH' % len(picked), *picked))
+	return [_scaled(value, dev) if dev.scale != 1 else value for value, (offset, dev) in zip(raw, points)]
+
+
+#--------------------------------------------------------------------------------------------------------------------#
+# value of dev times its scale. An integer value is rounded to the decimals of the scale, so 17 * 0.1 gives 1.7 and not
+# 1.7000000000000002. A float value keeps its own digits.
+#--------------------------------------------------------------------------------------------------------------------#
+def _scaled(value, dev):
+	if isinstance(value, float):
+		return value * dev.scale
+	return round(value * dev.scale, _decimals(dev.scale))
+
+
+#number of decimal places of scale, e.g. 1 for 0.1 and 3 for 0.125.
+@lru_cache(maxsize=256)
+def _decimals(scale):
+	return max(0, -Decimal(repr(scale)).as_tuple().exponent)
+
+
+#decodes the value of dev from its registers.
+def decode_value(dev, registers):
+	return decode_block(registers, [(0, dev)])[0]
+
+
+#encodes value into the registers of dev. The value is divided by the scale of dev, and rounded for integer types.
+def encode_value(dev, value):
+	code, count = TYPE_FORMATS[dev.dtype]
+	raw = value / dev.scale if dev.scale != 1 else value
+	if code not in 'fd':
+		raw = int(round(raw))
+	try:
+		regs = list(struct.unpack('>%dH' % count, struct.pack('>' + code, raw)))
+	except struct.error:
+		raise ValueError("%s is out of range for %s" % (value, dev.dtype))
+	if dev.byte_order == 'little':
+		regs = [((r & 0xFF) << 8) | (r >> 8) for r in regs]
+	if dev.word_order == 'little':
+		regs.reverse()
+	return regs
+
+
+#---------------------------------------------------------------------------------------------------------------------#
+# Encodes a batch of points, each (device name, value, timestamp), as one json or binary payload (see above).
+#---------------------------------------------------------------------------------------------------------------------#
+def encode_batch(points, encoding):
+	if encoding == 'json':
+		return json.dumps([[name, value, round(ts, 3)] for name, value, ts in points], separators=(',', ':'))
+	if encoding == 'binary':
+		parts = [struct.pack('<H', len(points))]
+		for name, value, ts in points:
+			name = name.encode('utf-8')
+			parts.append(struct.pack('<B%dsdd' % len(name), len(name), name, value, ts))
+		return b''.join(parts)
+	raise ValueError("Unknown batch encoding " + str(encoding))
+
+
+#decodes a binary batch back into a list of (device name, value, timestamp).
+def decode_binary_batch(payload):
+	count, = struct.unpack_from('<H', payload)
+	pos = 2
+	points = []
+	for i in range(count):
+		size = payload[pos]
+		name = payload[pos + 1:pos + 1 + size].decode('utf-8')
+		value, ts = struct.unpack_from('<dd', payload, pos + 1 + size)
+		points.append((name, value, ts))
+		pos += 1 + size + 16
+	return points
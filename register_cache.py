@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+'''
+Read-through cache of register values for modbus-mqtt_client.py.
+
+Values are kept per key, which the gateway makes of the endpoint, unit and register of a device and how its value is
+decoded, for the TTL of their device, with at most max_entries values kept and the least recently used one evicted
+first. Identical reads arriving while a read of the same key is already on its way to the slave do not send a request
+of their own : they share the future of the read in flight. Dashboards asking for the same device many times a second
+then cost the slave at most one read per TTL.
+'''
+
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+
+class RegisterCache(object):
+
+	def __init__(self, max_entries=10000):
+		self.max_entries = max_entries
+		self._lock = threading.Lock()
+		self._values = OrderedDict() 		#key -> (value, expiry time), least recently used first
+		self._inflight = {} 				#key -> future of the read on its way to the slave
+
+	#-----------------------------------------------------------------------------------------------------------------#
+	# Returns a future with the value of key. A value younger than ttl seconds is returned from the cache, else the
+	# read in flight for key is joined, else load() is called to start a read and must return its future. load() is
+	# called without the lock held, so a slow one does not hold up the reads of other keys.
+	#-----------------------------------------------------------------------------------------------------------------#
+	def read(self, key, ttl, load):
+		with self._lock:
+			entry = self._values.get(key)
+			if entry is not None:
+				if entry[1] > time.monotonic():
+					self._values.move_to_end(key)
+					future = Future()
+					future.set_result(entry[0])
+					return future
+				del self._values[key]
+			future = self._inflight.get(key)
+			if future is not None:
+				return future
+			future = self._inflight[key] = Future() 	#joined by identical reads while load() runs
+		future.add_done_callback(lambda done: self._read_done(key, ttl, done))
+		try:
+			loaded = load()
+		except Exception as e:
+			future.set_exception(e)
+			return future
+		loaded.add_done_callback(lambda done: _chain(done, future))
+		return future
+
+	def _read_done(self, key, ttl, future):
+		with self._lock:
+			if self._inflight.get(key) is not future:
+				return 					#a write replaced the value while this read was in flight
+			del self._inflight[key]
+			if future.exception() is None and ttl > 0:
+				self._store(key, future.result(), ttl)
+
+	#stores value for key, e.g. after it has been written or polled. Reads still in flight for key will not overwrite it.
+	def put(self, key, value, ttl):
+		with self._lock:
+			self._inflight.pop(key, None)
+			if ttl > 0:
+				self._store(key, value, ttl)
+			else:
+				self._values.pop(key, None)
+
+	def invalidate(self, key):
+		with self._lock:
+			self._inflight.pop(key, None)
+			self._values.pop(key, None)
+
+	def _store(self, key, value, ttl):
+		self._values[key] = (value, time.monotonic() + ttl)
+		self._values.move_to_end(key)
+		while len(self._values) > self.max_entries:
+			self._values.popitem(last=False)
+
+
+#completes future with the outcome of done.
+def _chain(done, future):
+	if done.cancelled():
+		future.cancel()
+	elif done.exception() is not None:
+		future.set_exception(done.exception())
+	else:
+		future.set_result(done.result())
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+'''
+Report-by-exception filter for the values polled by modbus-mqtt_client.py.
+
+Instead of publishing every polled value, a value is only published when it moved past the deadband of its device
+since the last published value. min_interval limits how often a fast changing device is published, and max_age
+publishes the value again after that many seconds even when it did not change, as a heartbeat showing the device is
+still read. Slowly changing sensors then cost a message now and then instead of one per poll.
+'''
+
+import threading
+
+
+class ExceptionReporter(object):
+
+	def __init__(self):
+		self._lock = threading.Lock()
+		self._last = {} 			#device name -> (last published value, time it was published)
+
+	#-----------------------------------------------------------------------------------------------------------------#
+	# Returns True if value read from dev at time now must be published, and records it as published if so.
+	# dev is a Device of device_table.py, its deadband, deadband_pct, min_interval and max_age fields are used.
+	#-----------------------------------------------------------------------------------------------------------------#
+	def should_report(self, dev, value, now):
+		with self._lock:
+			last = self._last.get(dev.name)
+			if last is not None:
+				last_value, last_time = last
+				age = now - last_time
+				if age < dev.min_interval:
+					return False
+				if not (dev.max_age > 0 and age >= dev.max_age) and not _exceeds_deadband(dev, last_value, value):
+					return False
+			self._last[dev.name] = (value, now)
+			return True
+
+	#forgets the last published value of device so its next value is published, e.g. after its config changed.
+	def reset(self, device=None):
+		with self._lock:
+			if device is None:
+				self._last.clear()
+			else:
+				self._last.pop(device, None)
+
+
+def _exceeds_deadband(dev, last_value, value):
+	change = abs(value - last_value)
+	if dev.deadband_pct:
+		return change > abs(last_value) * dev.deadband / 100.0 or (last_value == 0 and change > 0)
+	if dev.deadband > 0:
+		return change > dev.deadband
+	return value != last_value
@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+'''
+Consistent hashing of slave units over the running gateway instances, used by modbus-mqtt_client.py --shard.
+
+Every instance is placed on a hash ring at `replicas` points and a unit belongs to the first instance found clockwise
+from the hash of the unit id. When an instance joins or leaves only the units next to its points move, roughly
+1/N of them, and every instance computes the same owner for a unit from the same member list without talking to the
+others.
+
+Members announce themselves with a retained message on <MEMBERS_TOPIC>/<instance id> and their will clears it, so a
+new instance learns the current members from the retained messages and a crashed one drops out on its own.
+
+    ring = HashRing(['gw-a', 'gw-b'])
+    ring.owner(17) 		#'gw-a' or 'gw-b', the same on every instance
+'''
+
+import bisect
+import hashlib
+
+MEMBERS_TOPIC = 'gateway/members'
+
+
+def _hash(key):
+	return int(hashlib.md5(key.encode('utf-8')).hexdigest()[:16], 16)
+
+
+class HashRing(object):
+
+	def __init__(self, members=(), replicas=64):
+		self.replicas = replicas
+		self.members = frozenset(members)
+		points = sorted((_hash('%s#%d' % (member, i)), member) for member in self.members for i in range(replicas))
+		self._hashes = [point for point, member in points]
+		self._owners = [member for point, member in points]
+
+	def __len__(self):
+		return len(self.members)
+
+	#returns the member owning unit, None if the ring is empty.
+	def owner(self, unit):
+		if not self._hashes:
+			return None
+		index = bisect.bisect(self._hashes, _hash(str(unit)))
+		return self._owners[index % len(self._owners)]
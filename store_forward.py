@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+'''
+Store and forward of outgoing telemetry for modbus-mqtt_client.py.
+
+While the broker cannot be reached the polled values would be lost, and paho only queues in memory without a limit.
+StoreAndForward publishes straight away while connected and otherwise appends the message, with the time it was
+produced, to a DiskRingBuffer : a fixed size, memory mapped, append only ring in a file. The gateway's memory does not
+grow during an outage, and what was buffered survives a restart of the gateway.
+
+When the buffer is full the oldest message is dropped to make room (DROP_OLDEST), or the new one is (REJECT).
+
+After reconnecting the buffered messages are replayed in bulk on BACKFILL_TOPIC, oldest first, at most `rate`
+messages per second so the backlog does not crowd out live traffic. Every replay message is a JSON array of
+[topic, payload, timestamp] with the original topic and time; a payload which is not utf-8 text is given as
+{"base64": "..."}. Batches are sent at QoS 1 one at a time, the next one once the broker acknowledged the last. paho
+keeps a QoS 1 message until it is acknowledged and sends it again after a reconnect, so a batch leaves the buffer as
+soon as paho has taken it and a new outage does not send it twice.
+
+The buffer file is locked (flock) while it is open, so a second gateway given the same file fails with BufferInUseError
+instead of writing the same ring.
+
+File layout : a 64 byte header (magic, version, capacity, head, tail, count, sequence number of the head record)
+followed by `capacity` bytes of records. A record is a little endian uint32 record size, float64 timestamp and uint16
+topic length, then the utf-8 topic and the payload. A record which does not fit before the end of the file goes to
+the start, after a WRAP marker when there is room for it.
+'''
+
+import base64
+import fcntl
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+
+from gateway_core import REJECT, DROP_OLDEST
+
+import logging
+log = logging.getLogger(__name__)
+
+BACKFILL_TOPIC = 'backfill'
+
+_MAGIC = b'MQSF'
+_VERSION = 1
+_HEADER = struct.Struct('<4sIQQQQQ') 		#magic, version, capacity, head, tail, count, head sequence number
+_HEADER_SIZE = 64
+_RECORD = struct.Struct('<IdH') 			#record size, timestamp, topic length
+_WRAP = 0xFFFFFFFF
+
+
+#raised when another process has the buffer file open.
+class BufferInUseError(Exception):
+	pass
+
+
+class DiskRingBuffer(object):
+
+	#-----------------------------------------------------------------------------------------------------------------#
+	# path     - file holding the buffer. An existing buffer of the same capacity is reopened with its records.
+	# capacity - bytes available for records.
+	# overflow - DROP_OLDEST or REJECT, what to do when a new record does not fit.
+	#-----------------------------------------------------------------------------------------------------------------#
+	def __init__(self, path, capacity=16 * 1024 * 1024, overflow=DROP_OLDEST):
+		if overflow not in (REJECT, DROP_OLDEST):
+			raise ValueError("Unknown overflow policy " + str(overflow))
+		self.path = path
+		self.capacity = capacity
+		self.overflow = overflow
+		self.dropped = 0 				#records dropped or rejected because the buffer was full
+		self._lock = threading.Lock()
+		size = _HEADER_SIZE + capacity
+		fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+		try:
+			fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+		except OSError:
+			os.close(fd)
+			raise BufferInUseError("%s is in use by another process" % path)
+		try:
+			if os.fstat(fd).st_size != size:
+				os.ftruncate(fd, size)
+			self._map = mmap.mmap(fd, size)
+		except Exception:
+			os.close(fd)
+			raise
+		self._fd = fd 					#holds the lock until close()
+		magic, version, stored_capacity, head, tail, count, head_seq = _HEADER.unpack_from(self._map, 0)
+		if magic == _MAGIC and version == _VERSION and stored_capacity == capacity and max(head, tail) <= capacity:
+			self._head, self._tail, self._count, self._head_seq = head, tail, count, head_seq
+			if count:
+				log.info("Reopened %s with %d buffered records", path, count)
+		else:
+			self._head = self._tail = self._count = self._head_seq = 0
+			self._write_header()
+
+	def __len__(self):
+		return self._count
+
+	#bytes taken by records, wrap markers included.
+	def used(self):
+		with self._lock:
+			if not self._count:
+				return 0
+			if self._tail > self._head:
+				return self._tail - self._head
+			return self.capacity - self._head + self._tail
+
+	#-----------------------------------------------------------------------------------------------------------------#
+	# Appends one record. Returns False if it was rejected : the buffer is full and the policy is REJECT, or the
+	# record is larger than the whole buffer.
+	#-----------------------------------------------------------------------------------------------------------------#
+	def append(self, topic, payload, timestamp):
+		topic = topic.encode('utf-8')
+		size = _RECORD.size + len(topic) + len(payload)
+		with self._lock:
+			if size > self.capacity: 		#would not fit even into an empty buffer, keep the backlog
+				self.dropped += 1
+				return False
+			offset = self._place(size)
+			while offset is None and self._count and self.overflow == DROP_OLDEST:
+				self._drop_head()
+				self.dropped += 1
+				offset = self._place(size)
+			if offset is None:
+				self.dropped += 1
+				self._write_header()
+				return False
+			if offset == 0 and self._tail and self.capacity - self._tail >= 4:
+				struct.pack_into('<I', self._map, _HEADER_SIZE + self._tail, _WRAP)
+			start = _HEADER_SIZE + offset
+			_RECORD.pack_into(self._map, start, size, timestamp, len(topic))
+			start += _RECORD.size
+			self._map[start:start + len(topic)] = topic
+			self._map[start + len(topic):start + len(topic) + len(payload)] = payload
+			self._tail = offset + size
+			self._count += 1
+			self._write_header()
+			return True
+
+	#-----------------------------------------------------------------------------------------------------------------#
+	# Returns (sequence number, [(topic, payload, timestamp), ...]) of up to max_records of the oldest records without
+	# removing them. Pass the sequence number and the number of records to discard() once they have been forwarded.
+	#-----------------------------------------------------------------------------------------------------------------#
+	def peek(self, max_records):
+		records = []
+		with self._lock:
+			offset = self._head
+			for i in range(min(max_records, self._count)):
+				offset, size = self._record_at(offset)
+				start = _HEADER_SIZE + offset
+				size, timestamp, topic_size = _RECORD.unpack_from(self._map, start)
+				start += _RECORD.size
+				topic = self._map[start:start + topic_size].decode('utf-8')
+				records.append((topic, self._map[start + topic_size:_HEADER_SIZE + offset + size], timestamp))
+				offset += size
+			return self._head_seq, records
+
+	#removes the records peek() returned, unless they were dropped meanwhile to make room.
+	def discard(self, seq, count):
+		with self._lock:
+			while self._count and self._head_seq < seq + count:
+				self._drop_head()
+			self._write_header()
+
+	def flush(self):
+		self._map.flush()
+
+	def close(self):
+		with self._lock:
+			self._map.flush()
+			self._map.close()
+			os.close(self._fd)
+
+	#offset the next record of size bytes is written at, None if it does not fit. Must be called with the lock held.
+	def _place(self, size):
+		if not self._count:
+			self._head = self._tail = 0
+			return 0 if size <= self.capacity else None
+		if self._tail > self._head:
+			if self.capacity - self._tail >= size:
+				return self._tail
+			return 0 if self._head >= size else None
+		if self._tail < self._head and self._head - self._tail >= size:
+			return self._tail
+		return None 				#tail == head, the buffer is full
+
+	#(offset, size) of the record at offset, following a wrap to the start of the buffer.
+	def _record_at(self, offset):
+		if self.capacity - offset < 4:
+			offset = 0
+		size, = struct.unpack_from('<I', self._map, _HEADER_SIZE + offset)
+		if size == _WRAP:
+			offset = 0
+			size, = struct.unpack_from('<I', self._map, _HEADER_SIZE)
+		return offset, size
+
+	def _drop_head(self):
+		offset, size = self._record_at(self._head)
+		self._head = offset + size
+		self._count -= 1
+		self._head_seq += 1
+		if not self._count:
+			self._head = self._tail = 0
+
+	def _write_header(self):
+		_HEADER.pack_into(self._map, 0, _MAGIC, _VERSION, self.capacity, self._head, self._tail, self._count, self._head_seq)
+
+
+class StoreAndForward(object):
+
+	#-----------------------------------------------------------------------------------------------------------------#
+	# client     - connected paho client the telemetry is published with.
+	# buffer     - DiskRingBuffer holding the messages published while the broker was unreachable.
+	# rate       - largest number of buffered messages replayed per second.
+	# batch_size - number of buffered messages per replay message.
+	#-----------------------------------------------------------------------------------------------------------------#
+	def __init__(self, client, buffer, rate=500, batch_size=100, topic=BACKFILL_TOPIC):
+		self.client = client
+		self.buffer = buffer
+		self.rate = rate
+		self.batch_size = batch_size
+		self.topic = topic
+		self.replayed = 0 				#buffered messages forwarded after a reconnect
+		self._online = False 			#set by connected() and disconnected(), paho's is_connected() lags behind a lost connection
+		self._wake = threading.Event()
+		self._stop_event = threading.Event()
+		self._thread = threading.Thread(target=self._run, name="StoreAndForward")
+		self._thread.daemon = True
+
+	def start(self):
+		self._thread.start()
+
+	def stop(self):
+		self._stop_event.set()
+		self._wake.set()
+		self._thread.join()
+		self.buffer.close()
+
+	#starts replaying the buffer. Call it when the client (re)connected.
+	def connected(self):
+		self._online = True
+		self._wake.set()
+
+	#buffers everything from now on. Call it when the client lost its connection.
+	def disconnected(self):
+		self._online = False
+
+	#publishes a telemetry message, or buffers it with the current time when the broker cannot be reached.
+	def publish(self, topic, payload, qos=0):
+		if isinstance(payload, str):
+			payload = payload.encode('utf-8')
+		elif not isinstance(payload, bytes):
+			payload = str(payload).encode('utf-8') 	#numbers are sent as text, as paho does
+		if self._online and self.client.publish(topic, payload, qos=qos).rc == 0:
+			return
+		if not self.buffer.append(topic, payload, time.time()):
+			log.debug("Telemetry buffer full, dropped message on %s", topic)
+		self._wake.set()
+
+	def _run(self):
+		while not self._stop_event.is_set():
+			self._wake.wait(1)
+			self._wake.clear()
+			while len(self.buffer) and self._online and not self._stop_event.is_set():
+				started = time.monotonic()
+				sent = self._replay_batch()
+				if not sent:
+					break
+				self._stop_event.wait(max(0, sent / float(self.rate) - (time.monotonic() - started)))
+
+	#publishes the oldest batch on the backfill topic and removes it from the buffer once paho has it. Returns its size.
+	def _replay_batch(self):
+		seq, records = self.buffer.peek(self.batch_size)
+		if not records:
+			return 0
+		batch = []
+		for topic, payload, timestamp in records:
+			try:
+				payload = payload.decode('utf-8')
+			except UnicodeDecodeError:
+				payload = {'base64': base64.b64encode(payload).decode('ascii')}
+			batch.append([topic, payload, round(timestamp, 3)])
+		info = self.client.publish(self.topic, json.dumps(batch, separators=(',', ':')), qos=1)
+		if info.rc == mqtt.MQTT_ERR_NO_CONN:
+			self._online = False 		#paho queued the batch and sends it after reconnecting
+		elif info.rc != mqtt.MQTT_ERR_SUCCESS:
+			return 0
+		else:
+			info.wait_for_publish(10) 	#paces the replay by the acknowledgements of the broker
+		self.buffer.discard(seq, len(records))
+		self.replayed += len(records)
+		return len(records)
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+'''
+Fuzz check of the DiskRingBuffer of store_forward.py against a deque model.
+
+Random appends of records of random size (some larger than the whole buffer), peeks, discards and reopens of the file
+are run on small buffers, so the ring wraps and overflows all the time. After every step the buffer must hold the same
+records, in the same order, as the model. Run with python -m pytest test_store_forward.py, or as a script.
+'''
+
+import os
+import random
+import shutil
+import tempfile
+import unittest
+from collections import deque
+
+from gateway_core import DROP_OLDEST, REJECT
+from store_forward import DiskRingBuffer, BufferInUseError, _RECORD
+
+
+class DiskRingBufferFuzz(unittest.TestCase):
+
+	TRIALS = 40
+	STEPS = 2000
+
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		self.path = os.path.join(self.dir, 'fuzz.buf')
+
+	def tearDown(self):
+		shutil.rmtree(self.dir)
+
+	def test_drop_oldest(self):
+		self.fuzz(DROP_OLDEST)
+
+	def test_reject(self):
+		self.fuzz(REJECT)
+
+	def test_second_open_fails(self):
+		buffer = DiskRingBuffer(self.path, 1024)
+		try:
+			self.assertRaises(BufferInUseError, DiskRingBuffer, self.path, 1024)
+		finally:
+			buffer.close()
+
+	def fuzz(self, overflow):
+		rng = random.Random(overflow)
+		for trial in range(self.TRIALS):
+			if os.path.exists(self.path):
+				os.remove(self.path)
+			capacity = rng.randint(40, 400)
+			buffer = DiskRingBuffer(self.path, capacity, overflow)
+			model = deque() 				#(topic, payload, timestamp) of the records the buffer should hold, oldest first
+			for step in range(self.STEPS):
+				action = rng.random()
+				if action < 0.6:
+					topic = 't%d' % step
+					payload = os.urandom(rng.randint(0, capacity if rng.random() < 0.05 else 40))
+					before = len(model)
+					if buffer.append(topic, payload, float(step)):
+						model.append((topic, payload, float(step)))
+					elif overflow == REJECT or _RECORD.size + len(topic) + len(payload) > capacity:
+						self.assertEqual(len(buffer), before, "a rejected record dropped others")
+					while len(model) > len(buffer): 	#DROP_OLDEST made room
+						model.popleft()
+				elif action < 0.9:
+					seq, records = buffer.peek(rng.randint(1, 5))
+					self.assertEqual(records, list(model)[:len(records)])
+					if rng.random() < 0.8:
+						buffer.discard(seq, len(records))
+						for record in records:
+							model.popleft()
+				else:
+					buffer.close()
+					buffer = DiskRingBuffer(self.path, capacity, overflow)
+				self.assertEqual(len(buffer), len(model))
+				self.assertEqual(buffer.peek(len(model) + 1)[1], list(model))
+			buffer.close()
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+'''
+Write batching for modbus-mqtt_client.py.
+
+Writes are collected for a short window. Inside the window a later write to the same register replaces the earlier
+one (last write wins), and writes to adjacent registers of the same unit are sent together as one write_registers
+(function code 16) request. A burst of setpoints then costs one round trip per run of registers instead of one per
+message. Every write still gets its own future, resolved with the value that ended up in the register.
+'''
+
+import threading
+import time
+from concurrent.futures import Future
+
+import logging
+log = logging.getLogger(__name__)
+
+MAX_WRITE_REGISTERS = 123 		#largest write_registers request allowed by the MODBUS protocol
+
+
+#------------------------------------------------------------------------------------------------------------------------#
+# Splits the writes of one unit into runs of adjacent registers.
+# writes maps register -> entry. Returns a list of (start register, [entry, ...]) with at most max_count entries per run.
+#------------------------------------------------------------------------------------------------------------------------#
+def plan_block_writes(writes, max_count=MAX_WRITE_REGISTERS):
+	runs = []
+	for reg in sorted(writes):
+		if runs and reg == runs[-1][0] + len(runs[-1][1]) and len(runs[-1][1]) < max_count:
+			runs[-1][1].append(writes[reg])
+		else:
+			runs.append((reg, [writes[reg]]))
+	return runs
+
+
+class WriteBatcher(object):
+
+	#-----------------------------------------------------------------------------------------------------------------#
+	# submit_block - submit_block(unit, start, values) writes values from register start on and returns a future.
+	# window_ms    - how long writes are collected before they are sent. The window opens with the first write.
+	#-----------------------------------------------------------------------------------------------------------------#
+	def __init__(self, submit_block, window_ms=20, max_count=MAX_WRITE_REGISTERS):
+		self.submit_block = submit_block
+		self.window = window_ms / 1000.0
+		self.max_count = max_count
+		self._cond = threading.Condition()
+		self._pending = {} 				#unit -> {register: [value, [futures]]}
+		self._deadline = None 			#time the open window is flushed, None when no write is waiting
+		flusher = threading.Thread(target=self._run, name="WriteBatcher")
+		flusher.daemon = True
+		flusher.start()
+
+	#queues writes of values into the registers of unit from start on. Returns one future resolved with the list of values written.
+	def write_registers(self, unit, start, values):
+		return _gather([self.write(unit, start + i, value) for i, value in enumerate(values)])
+
+	#queues a write of value into register of unit. Returns a future resolved with the value written once it is acknowledged.
+	def write(self, unit, register, value):
+		future = Future()
+		with self._cond:
+			writes = self._pending.setdefault(unit, {})
+			entry = writes.get(register)
+			if entry is None:
+				writes[register] = [value, [future]]
+			else:
+				entry[0] = value 			#last write wins, the earlier future is acknowledged with this value
+				entry[1].append(future)
+			if self._deadline is None:
+				self._deadline = time.monotonic() + self.window
+				self._cond.notify()
+		return future
+
+	def _run(self):
+		while True:
+			with self._cond:
+				while self._deadline is None:
+					self._cond.wait()
+				delay = self._deadline - time.monotonic()
+				if delay > 0:
+					self._cond.wait(delay)
+					continue
+				pending, self._pending, self._deadline = self._pending, {}, None
+			self._flush(pending)
+
+	def _flush(self, pending):
+		for unit, writes in pending.items():
+			for start, entries in plan_block_writes(writes, self.max_count):
+				try:
+					block = self.submit_block(unit, start, [entry[0] for entry in entries])
+				except Exception as e:
+					block = Future()
+					block.set_exception(e)
+				block.add_done_callback(lambda done, entries=entries: _acknowledge(entries, done))
+
+
+#returns a future resolved with the results of all futures, or failing with the first error, once they are all done.
+def _gather(futures):
+	gathered = Future()
+	remaining = [len(futures)]
+	lock = threading.Lock()
+	def one_done(done):
+		with lock:
+			remaining[0] -= 1
+			if remaining[0]:
+				return
+		errors = [future.exception() for future in futures if future.exception() is not None]
+		if errors:
+			gathered.set_exception(errors[0])
+		else:
+			gathered.set_result([future.result() for future in futures])
+	for future in futures:
+		future.add_done_callback(one_done)
+	return gathered
+
+
+#resolves the future of every write of a block once the block has been written.
+def _acknowledge(entries, block):
+	error = block.exception()
+	for value, futures in entries:
+		for future in futures:
+			if future.set_running_or_notify_cancel():
+				if error is None:
+					future.set_result(value)
+				else:
+					future.set_exception(error)